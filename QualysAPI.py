@@ -1,6 +1,16 @@
 import requests
+import requests.adapters
+import threading
 import xml.etree.ElementTree as ET
-from time import sleep
+# lxml is much faster at incremental parsing, use it where it is installed.  Its XMLPullParser has the same interface
+try:
+    from lxml import etree as PullET
+except ImportError:
+    PullET = ET
+import QualysRateLimiter
+import QualysMetrics
+from time import perf_counter
+from urllib.parse import urlparse, parse_qs
 
 
 class QualysAPI:
@@ -16,11 +26,29 @@ class QualysAPI:
     debug           : Boolean : If True, will output debug information to the console during member function execution
     enableProxy     : Boolean : If True will force connections via the proxy defined in the 'proxy' class member
     callCount       : Integer : The number of API calls made during the life of the API object
+    concurrencyLimit: Integer : The last X-Concurrency-Limit-Limit value returned by the platform (None until seen)
+    concurrencyRunning: Integer : The last X-Concurrency-Limit-Running value returned by the platform (None until
+                                  seen)
+    maxRetries      : Integer : The number of times a rate or concurrency limited call is retried before the failure
+                                response is returned to the caller
+    limiter         : QualysRateLimiter : The rate limiter shared by all callers of this object.  The time spent
+                                          throttled is available from limiter.blockedTime() (wall-clock) and
+                                          limiter.throttledTime() (summed over callers)
+    metrics         : QualysMetrics : Per endpoint and action metrics for every call made by this object
+    debugLength     : Integer : The number of characters of each response printed when debug is True
+    pods            : Dict    : The API server URL of each Qualys Pod code, used by podPicker
+    timeout         : Tuple   : The (connect, read) timeouts of each request, in seconds
+    sessionLogin    : Boolean : If True, a QualysSession cookie is used to authenticate calls in place of basic auth
+    loggedIn        : Boolean : True while a QualysSession cookie is held
+
+    The session headers are set once, when the object is created, and the headers of each call are only merged in when
+    its request is prepared, so one object can be used by many threads at once.
 
     Class Methods
     =============
 
-    __init__(svr, usr, passwd, proxy, enableProxy, debug)
+    __init__(svr, usr, passwd, proxy, enableProxy, debug, maxRetries, baseBackoff, maxBackoff, traceHook, debugLength,
+             poolSize, connectTimeout, readTimeout, compress, sessionLogin)
 
         Called when an object of type QualysAPI is created
 
@@ -44,13 +72,52 @@ class QualysAPI:
                                     execution
                                     Default value = False
 
+            maxRetries  : Integer : The number of times a rate or concurrency limited call is retried
+                                    Default value = 20
+
+            baseBackoff : Float   : The first wait, in seconds, after a concurrency limit rejection
+                                    Default value = 2
+
+            maxBackoff  : Float   : The longest wait, in seconds, after a concurrency limit rejection
+                                    Default value = 60
+
+            traceHook   : Function: Called with a dict describing each completed call, for custom tracing (see
+                                    QualysMetrics).  Exceptions it raises are printed as warnings
+                                    Default value = None
+
+            debugLength : Integer : The number of characters of each response printed when debug is True
+                                    Default value = 2000
+
+            poolSize    : Integer : The number of connections to the API server kept alive for reuse.  Should be at
+                                    least the number of threads making calls at once
+                                    Default value = 10
+
+            connectTimeout : Float : Seconds to wait for a connection to the API server
+                                     Default value = 10
+
+            readTimeout : Float   : Seconds to wait for the server to send (the next part of) a response
+                                    Default value = 300
+
+            compress    : Boolean : If True, ask for responses to be gzip compressed
+                                    Default value = True
+
+            sessionLogin : Boolean : If True, log in on the first call and authenticate calls with the QualysSession
+                                     cookie rather than basic auth.  An expired session is logged in again
+                                     Default value = False
+
+    login() / logout()
+
+        Log in to (or out of) a session, with /api/2.0/fo/session/.  login returns False, and basic auth continues to be
+        used, if the login failed.  Called by makeCall when sessionLogin is True, so logout is the only one a caller
+        normally needs
+
     podPicker(pod)
 
-        Convert a POD string to an API URL
+        Static method to convert a POD string to an API URL.  Returns None if the POD is not known
 
             pod         : String  : The Qualys Pod code ('US01', 'US02', 'US03', 'EU01', 'EU02' or 'IN01')
 
-    makeCall(url, payload, headers, retryCount)
+    makeCall(url, payload, headers, retryCount, method, returnwith, fields)
 
         Make a Qualys API call and return the response in XML format as an ElementTree.Element object
 
@@ -63,10 +130,52 @@ class QualysAPI:
             headers     : Dict    : HTTP Request headers to be sent in the API call
                                     Default value = None
 
-            retryCount  : Integer : The number of times this call has been attempted.  Used in rate and concurrency
-                                    limit handling, not intended for use by users
+            retryCount  : Integer : The number of times this call has already been attempted.  Used in rate and
+                                    concurrency limit handling, not intended for use by users
                                     Default value = 0
 
+            method      : String  : The HTTP method of the request
+                                    Default value = 'POST'
+
+            returnwith  : String  : 'xml' to return an ElementTree.Element object, 'text' to return the response text,
+                                    'fields' to return a dict of the text of the elements in 'fields'.  In 'fields'
+                                    mode the response bytes are parsed incrementally (with lxml if installed) only
+                                    until the requested elements have been found, or can no longer appear
+                                    Default value = 'xml'
+
+            fields      : Tuple   : Paths of the elements, relative to the root element, whose text is returned when
+                                    returnwith is 'fields' (e.g. ('RESPONSE/CODE', 'RESPONSE/TEXT')).  Paths which
+                                    are not found have a value of None.  An empty or truncated response raises
+                                    xml.etree.ElementTree.ParseError (whichever parser is used), and an HTTP error
+                                    response without every one of the paths raises requests.HTTPError, so neither
+                                    can be mistaken for a response without them
+                                    Default value = ()
+
+    makeStreamingCall(url, tags, payload, headers, method, chunkSize)
+
+        Make a Qualys API call and parse the response incrementally as it is downloaded.  This is a generator which
+        yields each ElementTree.Element object whose tag is in 'tags' as soon as its end tag has been read.  Once the
+        caller has moved on, the element is removed from the tree, so memory use does not grow with the size of the
+        response
+
+            url         : String  : The full URL of the API request, including any URL encoded parameters
+                                    NO DEFAULT VALUE, REQUIRED PARAMETER
+
+            tags        : Tuple   : The element tags to be yielded (e.g. ('APPLIANCE', 'RESPONSE'))
+                                    NO DEFAULT VALUE, REQUIRED PARAMETER
+
+            payload     : String  : The payload (body) of the API request
+                                    Default value = ""
+
+            headers     : Dict    : HTTP Request headers to be sent in the API call
+                                    Default value = None
+
+            method      : String  : The HTTP method of the request
+                                    Default value = 'POST'
+
+            chunkSize   : Integer : The number of bytes read from the response at a time
+                                    Default value = 65536
+
         Example :
             api = QualysAPI(svr='https://qualysapi.qualys.com',
                             usr='username',
@@ -88,12 +197,31 @@ class QualysAPI:
     debug: bool
     enableProxy: bool
     callCount: int
+    maxRetries: int
+    limiter: QualysRateLimiter.QualysRateLimiter
+    metrics: QualysMetrics.QualysMetrics
+    debugLength: int
+    concurrencyLimit: int
+    concurrencyRunning: int
+    timeout: tuple
+    sessionLogin: bool
+    loggedIn: bool
 
     headers = {}
 
+    # The API server of each Qualys Pod
+    pods = {'US01': 'https://qualysapi.qualys.com',
+            'US02': 'https://qualysapi.qg2.apps.qualys.com',
+            'US03': 'https://qualysapi.qg3.apps.qualys.com',
+            'EU01': 'https://qualysapi.qualys.eu',
+            'EU02': 'https://qualysapi.qg2.apps.qualys.eu',
+            'IN01': 'https://qualysapi.qg1.apps.qualys.in'}
+
     sess: requests.Session
 
-    def __init__(self, svr="", usr="", passwd="", proxy="", enableProxy=False, debug=False):
+    def __init__(self, svr="", usr="", passwd="", proxy="", enableProxy=False, debug=False, maxRetries=20,
+                 baseBackoff=2.0, maxBackoff=60.0, traceHook=None, debugLength=2000, poolSize=10, connectTimeout=10.0,
+                 readTimeout=300.0, compress=True, sessionLogin=False):
         # Set all member variables from the values passed in when object is created
         self.server = svr
         self.user = usr
@@ -102,105 +230,322 @@ class QualysAPI:
         self.enableProxy = enableProxy
         self.debug = debug
         self.callCount = 0
+        self.concurrencyLimit = None
+        self.concurrencyRunning = None
+        self.maxRetries = maxRetries
+        self.debugLength = debugLength
+        self.timeout = (connectTimeout, readTimeout)
+        self.sessionLogin = sessionLogin
+        self.loggedIn = False
+        self._countLock = threading.Lock()
+        self._loginLock = threading.Lock()
+        # The number of successful logins, so threads which all saw the same session expire only log in again once
+        self._logins = 0
+
+        # All callers of this object share one rate limiter, so parallel callers are paced together
+        self.limiter = QualysRateLimiter.QualysRateLimiter(baseBackoff=baseBackoff, maxBackoff=maxBackoff)
+        # Per endpoint/action latency, size, parse time and throttling metrics for every call
+        self.metrics = QualysMetrics.QualysMetrics(traceHook=traceHook)
 
         # Create a session object with the requests library
         self.sess = requests.session()
+        # Keep up to poolSize connections alive so parallel callers each reuse a connection rather than opening a new
+        #   one for every call.  Retries are handled by _send, not by urllib3
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=poolSize, max_retries=0)
+        self.sess.mount('https://', adapter)
+        self.sess.mount('http://', adapter)
         # Set the authentication credentials for the session to be the (username, password) tuple
         self.sess.auth = (self.user, self.password)
         # Add a default X-Requested-With header (most API calls require it, it doesn't hurt to have it in all calls)
         self.sess.headers['X-Requested-With'] = 'python3/requests'
-
-    def makeCall(self, url, payload="", headers=None, retryCount=0, method='POST', returnwith='xml'):
-        # Get the headers from our own session object
-        rheaders = self.sess.headers
-        # If there are headers (meaning the __init__ method has been called and the api object was correctly created)
-        if headers is not None:
-            # copy each of the headers passed in via the 'headers' variable to the session headers so they are included
-            #   in the request
-            for h in headers.keys():
-                rheaders[h] = headers[h]
-
-        # Create a Request object using the requests library
-        r = requests.Request(method, url, data=payload, headers=rheaders)
-        # Prepare the request for sending
-        prepped_req = self.sess.prepare_request(r)
-        # If the proxy is enabled, send via the proxy
-        if self.enableProxy:
-            resp = self.sess.send(prepped_req, proxies={'https': self.proxy})
-        # Otherwise send direct
+        self.sess.headers['Connection'] = 'keep-alive'
+        # The full appliance list compresses very well
+        if compress:
+            self.sess.headers['Accept-Encoding'] = 'gzip, deflate'
         else:
-            resp = self.sess.send(prepped_req)
-
-        if self.debug:
-            print("QualysAPI.makeCall: Request Headers")
-            print("%s" % str(rheaders))
-            print("QualysAPI.makeCall: Request text")
-            print("%s" % str(r.url))
-            print("QualysAPI.makeCall: Request data")
-            print("%s" % str(r.data))
-            print("QualysAPI.makeCall: Response Headers...")
-            print("%s" % str(resp.headers))
-            print("QualysAPI.makeCall: Response text...")
-            print("%s" % resp.text)
-
-        # Handle concurrency limit failures
-        if 'X-Concurrency-Limit-Limit' in resp.headers.keys() and 'X-Concurrency-Limit-Running' in resp.headers.keys():
-            climit = int(resp.headers['X-Concurrency-Limit-Limit'])
-            crun = int(resp.headers['X-Concurrency-Limit-Running'])
-            # If crun > climit then we have hit the concurrency limit.  We then wait for a number of seconds depending
-            #   on how many retry attempts there have been
-            if crun >= climit:
-                print("QualysAPI.makeCall: Concurrency limit hit.  %s/%s running calls" % (crun, climit))
+            self.sess.headers['Accept-Encoding'] = 'identity'
+
+    @staticmethod
+    def podPicker(pod):
+        # Returns None (after printing the error) if the pod code is not known
+        if pod.upper() not in QualysAPI.pods.keys():
+            print('ERROR: Unknown Qualys Pod %s (must be one of %s)' % (pod, ', '.join(QualysAPI.pods.keys())))
+            return None
+        return QualysAPI.pods[pod.upper()]
+
+    def login(self, after=None):
+        # after is the login count when the caller's session expired.  If it has changed, another thread has already
+        #   logged in again
+        with self._loginLock:
+            if after is None and self.loggedIn:
+                return True
+            if after is not None and after != self._logins:
+                return True
+            proxies = {'https': self.proxy} if self.enableProxy else None
+            try:
+                resp = self.sess.post('%s/api/2.0/fo/session/' % self.server,
+                                      data={'action': 'login', 'username': self.user, 'password': self.password},
+                                      timeout=self.timeout, proxies=proxies)
+            except requests.RequestException as e:
+                print('QualysAPI.login: Login failed (%s), using basic auth' % e)
+                self._basicAuth()
+                return False
+            if resp.status_code != 200 or 'QualysSession' not in self.sess.cookies.keys():
+                print('QualysAPI.login: Login failed (HTTP %s), using basic auth' % resp.status_code)
+                self._basicAuth()
+                return False
+            # From now on the cookie authenticates each call
+            self.sess.auth = None
+            self.loggedIn = True
+            self._logins = self._logins + 1
+            return True
+
+    def _basicAuth(self):
+        # Go back to basic auth for the rest of the life of this object
+        self.sessionLogin = False
+        self.loggedIn = False
+        self.sess.auth = (self.user, self.password)
+
+    def logout(self):
+        with self._loginLock:
+            if not self.loggedIn:
+                return
+            proxies = {'https': self.proxy} if self.enableProxy else None
+            try:
+                self.sess.post('%s/api/2.0/fo/session/' % self.server, data={'action': 'logout'},
+                               timeout=self.timeout, proxies=proxies)
+            except requests.RequestException as e:
+                print('QualysAPI.logout: Logout failed (%s)' % e)
+            self.sess.cookies.clear()
+            self.sess.auth = (self.user, self.password)
+            self.loggedIn = False
+
+    @staticmethod
+    def _newCall(url):
+        # Start the metrics record for a call, see QualysMetrics
+        parsed = urlparse(url)
+        action = parse_qs(parsed.query).get('action')
+        return {'endpoint': parsed.path, 'action': action[0] if action else None, 'status': 0, 'latency': 0.0,
+                'bytes_sent': 0, 'bytes_received': 0, 'parse_time': 0.0, 'retries': 0, 'rate_sleep': 0.0,
+                'concurrency_sleep': 0.0}
+
+    def _send(self, url, payload, rheaders, retryCount, method, stream=False, call=None):
+        # Rate and concurrency limit rejections are retried in this loop (rather than by recursion) so the caller's
+        #   method and returnwith are preserved and the stack does not grow
+        if self.sessionLogin and not self.loggedIn:
+            self.login()
+
+        while True:
+            # Wait for the shared limiter to allow the call, this paces all callers of this object together
+            waited = self.limiter.acquire()
+            logins = self._logins
+
+            # Create a Request object using the requests library
+            r = requests.Request(method, url, data=payload, headers=rheaders)
+            # Prepare the request for sending
+            prepped_req = self.sess.prepare_request(r)
+            start = perf_counter()
+            # If the proxy is enabled, send via the proxy
+            if self.enableProxy:
+                resp = self.sess.send(prepped_req, proxies={'https': self.proxy}, stream=stream, timeout=self.timeout)
+            # Otherwise send direct
+            else:
+                resp = self.sess.send(prepped_req, stream=stream, timeout=self.timeout)
+
+            if call is not None:
+                # Latency is for the final attempt, up to the end of the body (or the headers, for streamed responses)
+                call['latency'] = perf_counter() - start
+                call['status'] = resp.status_code
+                call['rate_sleep'] = call['rate_sleep'] + waited
+                call['bytes_sent'] = call['bytes_sent'] + len(prepped_req.url) + len(prepped_req.body or '')
+
+            if self.debug:
+                print("QualysAPI.makeCall: Request Headers")
+                print("%s" % str({h: v for h, v in prepped_req.headers.items() if h != 'Authorization'}))
+                print("QualysAPI.makeCall: Request text")
+                print("%s" % str(r.url))
+                print("QualysAPI.makeCall: Request data")
+                print("%s" % str(r.data))
+                print("QualysAPI.makeCall: Response Headers...")
+                print("%s" % str(resp.headers))
+                # Streamed responses are consumed by the caller, reading the text here would defeat the purpose.  Long
+                #   responses (e.g. the full appliance list) are cut short, printing them is slow and not useful
+                if not stream:
+                    print("QualysAPI.makeCall: Response text...")
+                    if len(resp.text) > self.debugLength:
+                        print("%s... (%s more characters)" % (resp.text[:self.debugLength],
+                                                             len(resp.text) - self.debugLength))
+                    else:
+                        print("%s" % resp.text)
+
+            # A session which has expired is logged in again (once, by whichever thread gets there first) and the call
+            #   is retried
+            if resp.status_code == 401 and self.loggedIn and retryCount < self.maxRetries:
                 retryCount = retryCount + 1
-                if retryCount > 15:
-                    print("QualysAPI.makeCall: Retry count > 15, waiting 60 seconds")
-                    waittime = 60
-                elif retryCount > 5:
-                    print("QualysAPI.makeCall: Retry count > 5, waiting 30 seconds")
-                    waittime = 30
-                else:
-                    print("QualysAPI.makeCall: Waiting 15 seconds")
-                    waittime = 15
-                # Sleep here
-                sleep(waittime)
-                print("QualysAPI.makeCall: Retrying (retryCount = %s)" % str(retryCount))
-
-                # Make a self-referential call to this same class method, passing in the retry count so the next
-                #   iteration knows how many attempts have been made so far
-                resp = self.makeCall(url=url, payload=payload, headers=headers, retryCount=retryCount)
-
-        # Handle rate limit failures
-        if 'X-RateLimit-ToWait-Sec' in resp.headers.keys():
-            if int(resp.headers['X-RateLimit-ToWait-Sec']) > 0:
-                # If this response header has a value > 0, we know we have to wait some time so first we increment
-                #   the retryCount
+                print("QualysAPI.makeCall: Session expired, logging in again (retryCount = %s)" % retryCount)
+                resp.close()
+                self.login(after=logins)
+                continue
+
+            # Let the limiter learn the subscription's budget from the response headers
+            towait = self.limiter.observe(resp.headers)
+
+            # Handle rate limit failures.  The limiter has already blocked all callers for the time the platform
+            #   asked for, so we only need to go round again
+            if towait > 0:
+                if retryCount >= self.maxRetries:
+                    # Give up and hand the failure response back to the caller
+                    print("QualysAPI.makeCall: Retry count >= %s, giving up" % self.maxRetries)
+                    break
                 retryCount = retryCount + 1
+                if call is not None:
+                    call['retries'] = call['retries'] + 1
+                print("QualysAPI.makeCall: Rate limit reached, waiting %s seconds (retryCount = %s)" %
+                      (towait, retryCount))
+                resp.close()
+                continue
+
+            # Handle concurrency limit failures
+            if 'X-Concurrency-Limit-Limit' in resp.headers.keys() and \
+                    'X-Concurrency-Limit-Running' in resp.headers.keys():
+                climit = int(resp.headers['X-Concurrency-Limit-Limit'])
+                crun = int(resp.headers['X-Concurrency-Limit-Running'])
+                # Remember the most recent values so that callers running calls in parallel can size their workload
+                self.concurrencyLimit = climit
+                self.concurrencyRunning = crun
+                # The platform rejects calls over the concurrency limit with 409 Conflict
+                if resp.status_code == 409 and crun >= climit:
+                    if retryCount >= self.maxRetries:
+                        print("QualysAPI.makeCall: Retry count >= %s, giving up" % self.maxRetries)
+                        break
+                    retryCount = retryCount + 1
+                    print("QualysAPI.makeCall: Concurrency limit hit.  %s/%s running calls" % (crun, climit))
+                    waittime = self.limiter.backoff(retryCount)
+                    if call is not None:
+                        call['retries'] = call['retries'] + 1
+                        call['concurrency_sleep'] = call['concurrency_sleep'] + waittime
+                    print("QualysAPI.makeCall: Waited %.1f seconds, retrying (retryCount = %s)" %
+                          (waittime, retryCount))
+                    resp.close()
+                    continue
+
+            break
+
+        return resp
+
+    @staticmethod
+    def _findFields(content, fields, chunkSize=65536):
+        # Parse the raw response bytes only as far as needed to find the text of each of the paths in 'fields'
+        ret_val = dict.fromkeys(fields)
+        remaining = set(fields)
+        try:
+            parser = PullET.XMLPullParser(events=('start', 'end'))
+            path = []
+            for index in range(0, len(content), chunkSize):
+                parser.feed(content[index:index + chunkSize])
+                for event, elem in parser.read_events():
+                    if event == 'start':
+                        path.append(elem.tag)
+                        continue
+                    current = '/'.join(path[1:])
+                    path.pop()
+                    if current in remaining:
+                        ret_val[current] = elem.text
+                        remaining.discard(current)
+                    # Once an element has ended, nothing else can appear inside it, so stop when every path still
+                    #   missing is inside an element which has ended (or when there are none left)
+                    if len(remaining) == 0 or all(field.startswith(current + '/') for field in remaining) or \
+                            current == '':
+                        return ret_val
+            # The bytes ran out before the root element ended.  Closing the parser raises an error for an empty or
+            #   truncated response
+            parser.close()
+        except PullET.ParseError as e:
+            if PullET is ET:
+                raise
+            # lxml raises its own XMLSyntaxError, which callers catching ElementTree's ParseError would miss
+            raise ET.ParseError(str(e)) from e
+        return ret_val
+
+    def makeCall(self, url, payload="", headers=None, retryCount=0, method='POST', returnwith='xml', fields=()):
+        # The headers of this call only.  The session headers are merged in when the request is prepared, and are never
+        #   changed here, so headers cannot leak into calls made later or from other threads
+        rheaders = {}
+        if headers is not None:
+            rheaders.update(headers)
 
-                # Get the number of seconds to wait from the response header.  Add to this a number of seconds depending
-                #   on how many times we have already tried this call
-                waittime = int(resp.headers['X-RateLimit-ToWait-Sec'])
-                print("QualysAPI.makeCall: Rate limit reached, suggested wait time: %s seconds" % waittime)
-                if retryCount > 15:
-                    print("QualysAPI.makeCall: Retry Count > 15, adding 60 seconds to wait time")
-                    waittime = waittime + 60
-                elif retryCount > 5:
-                    print("QualysAPI.makeCall: Retry Count > 5, adding 30 seconds to wait time")
-                    waittime = waittime + 30
-
-                # Sleep here
-                sleep(waittime)
-                print("QualysAPI.makeCall: Retrying (retryCount = %s)" % str(retryCount))
-
-                # Make a self-referential call to this same class method, passing in the retry count so the next
-                #   iteration knows how many attempts have been made so far
-                resp = self.makeCall(url=url, payload=payload, headers=headers, retryCount=retryCount)
+        call = self._newCall(url)
+        resp = self._send(url=url, payload=payload, rheaders=rheaders, retryCount=retryCount, method=method, call=call)
+        call['bytes_received'] = len(resp.content)
 
         # Increment the API call count (failed calls are not included in the count)
-        self.callCount = self.callCount + 1
+        with self._countLock:
+            self.callCount = self.callCount + 1
 
         if returnwith == 'xml':
             # Return the response as an ElementTree XML object
-            return ET.fromstring(resp.text)
+            start = perf_counter()
+            try:
+                ret_val = ET.fromstring(resp.text)
+            finally:
+                call['parse_time'] = perf_counter() - start
+                self.metrics.record(call)
+            return ret_val
+        if returnwith == 'fields':
+            start = perf_counter()
+            try:
+                ret_val = self._findFields(resp.content, fields)
+            finally:
+                call['parse_time'] = perf_counter() - start
+                self.metrics.record(call)
+            if not 200 <= resp.status_code < 300 and None in ret_val.values():
+                # An error page from a proxy or load balancer is not a response from the API, so must not be taken
+                #   for one which has no error CODE
+                raise requests.HTTPError('HTTP %s %s from %s' % (resp.status_code, resp.reason, urlparse(url).path),
+                                         response=resp)
+            return ret_val
+        self.metrics.record(call)
         if returnwith == 'text':
             # Return with the response as a text string
             return resp.text
+
+    def makeStreamingCall(self, url, tags, payload="", headers=None, method='POST', chunkSize=65536):
+        # The headers of this call only, as in makeCall
+        rheaders = {}
+        if headers is not None:
+            rheaders.update(headers)
+
+        call = self._newCall(url)
+        resp = self._send(url=url, payload=payload, rheaders=rheaders, retryCount=0, method=method, stream=True,
+                          call=call)
+
+        with self._countLock:
+            self.callCount = self.callCount + 1
+
+        # Parse the response incrementally as the chunks arrive.  The stack holds the open (not yet ended) elements so
+        #   each element we hand back can be detached from its parent once the caller is done with it, which means the
+        #   tree never holds more than one of them at a time
+        parser = PullET.XMLPullParser(events=('start', 'end'))
+        stack = []
+        parse_time = 0.0
+        try:
+            for chunk in resp.iter_content(chunk_size=chunkSize):
+                call['bytes_received'] = call['bytes_received'] + len(chunk)
+                start = perf_counter()
+                parser.feed(chunk)
+                events = parser.read_events()
+                parse_time = parse_time + perf_counter() - start
+                for event, elem in events:
+                    if event == 'start':
+                        stack.append(elem)
+                        continue
+                    stack.pop()
+                    if elem.tag in tags:
+                        yield elem
+                        if len(stack) > 0:
+                            stack[-1].remove(elem)
+            parser.close()
+        finally:
+            resp.close()
+            call['parse_time'] = parse_time
+            self.metrics.record(call)
@@ -0,0 +1,172 @@
+import bisect
+import QualysIPv4
+import QualysVirtualScannerAppliance
+
+
+class QualysConfigValidator:
+    """Class to check VLAN and Static Route configurations before any update is sent to the Qualys platform
+
+    Every address and netmask is turned into a numeric (start, end) range.  Each appliance's VLAN subnets are sorted
+    into an interval index which is swept once for overlaps and then searched (by bisection) for each route gateway,
+    so checking an appliance with n VLANs and routes takes O(n log n) time.  Problems are collected rather than raised
+    so they can all be reported together.
+
+    Class Members
+    =============
+
+    problems        : List    : A description of each problem found so far
+
+    Class Methods
+    =============
+
+    __init__()
+
+        Called when an object of type QualysConfigValidator is created
+
+    validate_rows(rows, kind, source)
+
+        Check the column count, action, name and address formats of CSV rows, and that no VLAN ID (or route name) is
+        added to the same appliance more than once with different values.  Only the VLAN ID (or route name) of a
+        remove row is checked.  Returns True if no problems were found
+
+            rows        : List    : The rows read from the CSV file
+            kind        : String  : 'vlan' or 'route'
+            source      : String  : The name of the CSV file, used in problem descriptions
+
+    validate_appliance(appliance)
+
+        Check the final configuration of an appliance for overlapping VLAN subnets, route gateways outside any subnet
+        the appliance can reach and routes which shadow each other.  The gateway check is only made for appliances
+        whose interface addresses are known.  Returns True if no problems were found
+
+            appliance   : QualysVirtualScannerAppliance : The appliance to check
+    """
+
+    problems: list
+
+    def __init__(self):
+        self.problems = []
+
+    @staticmethod
+    def _range(address: int, mask: int):
+        # Returns the (start, end) addresses of the subnet containing address
+        hostmask = ~mask & 0xFFFFFFFF
+        if hostmask & (hostmask + 1) != 0:
+            raise ValueError("'%s' is not a valid netmask" % QualysIPv4.unpack(mask))
+        start = address & mask
+        return start, start | hostmask
+
+    @staticmethod
+    def _cidr(subnet: tuple):
+        size = subnet[1] - subnet[0] + 1
+        return '%s/%s' % (QualysIPv4.unpack(subnet[0]), 33 - size.bit_length())
+
+    def validate_rows(self, rows: list, kind: str, source: str):
+        count = len(self.problems)
+        # (appliance name, VLAN ID or route name) as key, (line, values) of the first add row as value
+        added = {}
+        for line, row in enumerate(rows, start=1):
+            if len(row) != 6:
+                self.problems.append('%s line %s: Expected 6 columns, found %s' % (source, line, len(row)))
+                continue
+            if row[5] not in ('add', 'remove'):
+                self.problems.append('%s line %s: Action must be add or remove, found "%s"' % (source, line, row[5]))
+            if row[0].strip() == '':
+                self.problems.append('%s line %s: Missing appliance name' % (source, line))
+            if kind == 'vlan' and not (row[1].strip().isdigit() and 1 <= int(row[1]) <= 4094):
+                self.problems.append('%s line %s: Invalid VLAN ID "%s"' % (source, line, row[1]))
+            if kind == 'route' and row[1].strip() == '':
+                self.problems.append('%s line %s: Missing route name' % (source, line))
+
+            key = (row[0], row[1].strip())
+            if row[5] == 'remove':
+                # A remove row is applied by VLAN ID (or route name) alone, so its other columns are not checked.  A
+                #   later add of the same VLAN ID (or route name) replaces it rather than duplicating it
+                added.pop(key, None)
+                continue
+
+            # The update request separates VLANs (and routes) with ',' and their values with '|', and the platform has
+            #   no way of escaping either, so a name containing them would be split into malformed entries
+            name = row[4] if kind == 'vlan' else row[1]
+            if ',' in name or '|' in name:
+                self.problems.append('%s line %s: %s name "%s" must not contain "," or "|"' %
+                                     (source, line, 'VLAN' if kind == 'vlan' else 'Route', name))
+            try:
+                self._range(QualysIPv4.pack(row[2]), QualysIPv4.pack(row[3]))
+                if kind == 'route':
+                    QualysIPv4.pack(row[4])
+            except ValueError as e:
+                self.problems.append('%s line %s: %s' % (source, line, e))
+
+            if row[5] == 'add':
+                if key not in added:
+                    added[key] = (line, row[2:5])
+                elif added[key][1] != row[2:5]:
+                    self.problems.append('%s line %s: Duplicate %s %s for appliance %s (first added on line %s)' %
+                                         (source, line, 'VLAN ID' if kind == 'vlan' else 'route name', key[1], row[0],
+                                          added[key][0]))
+        return len(self.problems) == count
+
+    def validate_appliance(self, appliance: QualysVirtualScannerAppliance.QualysVirtualScannerAppliance):
+        count = len(self.problems)
+        prefix = 'Appliance %s' % appliance.name
+
+        # Build the VLAN interval index, sorted by start address.  VLAN IDs and route names are unique as they are the
+        #   keys of the appliance's dicts
+        vlans = []
+        for vlan in appliance.vlans.values():
+            try:
+                vlans.append(self._range(vlan.address, vlan.mask) + (vlan.vlan_id,))
+            except ValueError as e:
+                self.problems.append('%s: VLAN %s: %s' % (prefix, vlan.vlan_id, e))
+        vlans.sort()
+
+        # Sweep for overlaps, remembering the subnet reaching furthest so far.  Any subnet starting before it ends
+        #   overlaps it
+        widest = None
+        for vlan in vlans:
+            if widest is not None and vlan[0] <= widest[1]:
+                self.problems.append('%s: VLAN %s (%s) overlaps VLAN %s (%s)' %
+                                     (prefix, vlan[2], self._cidr(vlan), widest[2], self._cidr(widest)))
+            if widest is None or vlan[1] > widest[1]:
+                widest = vlan
+
+        # Build the route list, sorted by destination, so identical destinations are adjacent
+        routes = []
+        for route in appliance.routes.values():
+            try:
+                routes.append(self._range(route.address, route.mask) + (route.route_name, route.gateway))
+            except ValueError as e:
+                self.problems.append('%s: Route %s: %s' % (prefix, route.route_name, e))
+        routes.sort()
+
+        for previous, route in zip(routes, routes[1:]):
+            if previous[:2] == route[:2]:
+                self.problems.append('%s: Route %s shadows route %s (both %s)' %
+                                     (prefix, route[2], previous[2], self._cidr(route)))
+
+        if len(appliance.interfaces) > 0:
+            # Merge the VLAN and interface subnets into disjoint ranges and check each gateway falls inside one
+            reachable = [vlan[:2] for vlan in vlans]
+            for if_addr, if_netmask in appliance.interfaces:
+                try:
+                    reachable.append(self._range(QualysIPv4.pack(if_addr), QualysIPv4.pack(if_netmask)))
+                except ValueError:
+                    pass
+            reachable.sort()
+            merged = []
+            for subnet in reachable:
+                if len(merged) > 0 and subnet[0] <= merged[-1][1] + 1:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], subnet[1]))
+                else:
+                    merged.append(subnet)
+            starts = [subnet[0] for subnet in merged]
+            for route in routes:
+                if route[3] is None:
+                    continue
+                index = bisect.bisect_right(starts, route[3]) - 1
+                if index < 0 or route[3] > merged[index][1]:
+                    self.problems.append('%s: Route %s gateway %s is not in any subnet of the appliance' %
+                                         (prefix, route[2], QualysIPv4.unpack(route[3])))
+
+        return len(self.problems) == count
@@ -0,0 +1,21 @@
+def pack(address):
+    # Convert a dotted-quad IPv4 address or netmask to a 32-bit integer.  Integers (e.g. from the cache) and None are
+    # returned unchanged
+    if address is None or isinstance(address, int):
+        return address
+    octets = address.strip().split('.')
+    if len(octets) != 4:
+        raise ValueError("'%s' is not a valid IPv4 address" % address)
+    value = 0
+    for octet in octets:
+        if not octet.isdigit() or int(octet) > 255:
+            raise ValueError("'%s' is not a valid IPv4 address" % address)
+        value = (value << 8) | int(octet)
+    return value
+
+
+def unpack(value):
+    # Convert a 32-bit integer back to a dotted-quad IPv4 address or netmask
+    if value is None:
+        return None
+    return '%d.%d.%d.%d' % (value >> 24, (value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF)
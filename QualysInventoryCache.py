@@ -0,0 +1,132 @@
+import gzip
+import hashlib
+import json
+import os
+from time import time
+import QualysVirtualScannerAppliance
+
+
+class QualysInventoryCache:
+    """Class to keep a local, on-disk copy of the appliance inventory of a subscription between runs
+
+    The cache is stored as one gzipped JSON file per API URL and user, holding the appliance name to ID map and the
+    compact (to_list) form of each QualysVirtualScannerAppliance object.  Each entry carries the time it was stored
+    and is ignored once it is older than the TTL.
+
+    Class Members
+    =============
+
+    api_url         : String  : The base URL of the API service the inventory was read from
+    user            : String  : The username of the API user the inventory was read with
+    cache_dir       : String  : The directory holding the cache files
+    ttl             : Integer : The number of seconds an entry remains valid
+    refresh         : Boolean : If True, all existing entries are ignored (but new entries are still stored)
+    path            : String  : The full path of the cache file for this API URL and user
+
+    Class Methods
+    =============
+
+    __init__(api_url, user, cache_dir, ttl, refresh)
+
+        Called when an object of type QualysInventoryCache is created.  Loads the cache file if it exists
+
+            api_url     : String  : The base URL of the API service
+                                    NO DEFAULT VALUE, REQUIRED PARAMETER
+
+            user        : String  : The username of the API user
+                                    NO DEFAULT VALUE, REQUIRED PARAMETER
+
+            cache_dir   : String  : The directory holding the cache files
+                                    Default value = '~/.cache/qvsa_configurator'
+
+            ttl         : Integer : The number of seconds an entry remains valid
+                                    Default value = 300
+
+            refresh     : Boolean : If True, all existing entries are ignored
+                                    Default value = False
+
+    get_names() / put_names(names)
+
+        Get (None if missing or expired) or store the appliance name to ID dict
+
+    get_appliance(appliance_id) / put_appliance(appliance)
+
+        Get (None if missing or expired) or store a QualysVirtualScannerAppliance object.  put_appliance must be called
+        before the object is modified
+
+    invalidate(appliance_id)
+
+        Remove the entry for an appliance, e.g. after it has been updated
+
+    save()
+
+        Write the cache file
+    """
+
+    api_url: str
+    user: str
+    cache_dir: str
+    ttl: int
+    refresh: bool
+    path: str
+
+    def __init__(self, api_url, user, cache_dir='~/.cache/qvsa_configurator', ttl=300, refresh=False):
+        self.api_url = api_url
+        self.user = user
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.ttl = ttl
+        self.refresh = refresh
+
+        key = hashlib.sha256(('%s\0%s' % (api_url, user)).encode('utf-8')).hexdigest()[:32]
+        self.path = os.path.join(self.cache_dir, '%s.json.gz' % key)
+
+        self._data = {'api_url': api_url, 'user': user, 'names': None, 'appliances': {}}
+        if not refresh:
+            self._load()
+
+    def _load(self):
+        try:
+            with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            # A missing or unreadable cache file is the same as an empty cache
+            return
+        # Guard against (unlikely) hash collisions
+        if data.get('api_url') == self.api_url and data.get('user') == self.user:
+            self._data = data
+
+    def _fresh(self, stored):
+        return time() - stored <= self.ttl
+
+    def get_names(self):
+        entry = self._data['names']
+        if entry is None or not self._fresh(entry[0]):
+            return None
+        return entry[1]
+
+    def put_names(self, names: dict):
+        self._data['names'] = [time(), names]
+
+    def get_appliance(self, appliance_id):
+        entry = self._data['appliances'].get(appliance_id)
+        if entry is None or not self._fresh(entry[0]):
+            return None
+        return QualysVirtualScannerAppliance.QualysVirtualScannerAppliance.from_list(entry[1])
+
+    def put_appliance(self, appliance: QualysVirtualScannerAppliance.QualysVirtualScannerAppliance):
+        self._data['appliances'][appliance.id] = [time(), appliance.to_list()]
+
+    def invalidate(self, appliance_id):
+        self._data['appliances'].pop(appliance_id, None)
+
+    def save(self):
+        # Drop expired entries so the file does not grow without bound, then write via a temporary file so an
+        #   interrupted run cannot leave a truncated cache behind
+        for appliance_id in [k for k, v in self._data['appliances'].items() if not self._fresh(v[0])]:
+            del self._data['appliances'][appliance_id]
+
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump(self._data, f, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
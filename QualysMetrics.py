@@ -0,0 +1,142 @@
+import json
+import os
+import threading
+
+
+class QualysMetrics:
+    """Class to collect per-call metrics from a QualysAPI object and export them as JSON or Prometheus text
+
+    Metrics are kept per (endpoint, action) pair, where endpoint is the path of the API URL and action is the value of
+    its action parameter.
+
+    Class Members
+    =============
+
+    buckets         : List    : The upper bounds, in seconds, of the latency histogram buckets
+    traceHook       : Function: Called with a dict describing each completed call (or None).  The dict holds
+                                endpoint, action, status, latency, bytes_sent, bytes_received, parse_time, retries,
+                                rate_sleep and concurrency_sleep
+    endpoints       : Dict    : (endpoint, action) as key, dict of totals and bucket counts as value
+
+    Class Methods
+    =============
+
+    __init__(traceHook, buckets)
+
+        Called when an object of type QualysMetrics is created
+
+            traceHook   : Function: Called with a dict describing each completed call
+                                    Default value = None
+
+            buckets     : List    : The upper bounds, in seconds, of the latency histogram buckets
+                                    Default value = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+    record(call)
+
+        Add a completed call (a dict as described for traceHook) to the metrics and pass it to the traceHook.  An
+        exception raised by the traceHook is printed as a warning rather than raised
+
+    to_json() / to_prometheus()
+
+        Return the metrics as a JSON string or in the Prometheus text exposition format
+
+    write(file, format)
+
+        Write the metrics to a file in 'json' or 'prometheus' format.  The file is replaced atomically, so it can be
+        read by the Prometheus node exporter's textfile collector
+    """
+
+    buckets: list
+    endpoints: dict
+
+    def __init__(self, traceHook=None, buckets=None):
+        self.traceHook = traceHook
+        if buckets is None:
+            buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+        self.buckets = sorted(buckets)
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+    def record(self, call: dict):
+        key = (call['endpoint'], call['action'])
+        with self._lock:
+            if key not in self.endpoints:
+                self.endpoints[key] = {'calls': 0, 'errors': 0, 'latency_sum': 0.0, 'bytes_sent': 0,
+                                       'bytes_received': 0, 'parse_time': 0.0, 'retries': 0, 'rate_sleep': 0.0,
+                                       'concurrency_sleep': 0.0, 'buckets': [0] * len(self.buckets)}
+            totals = self.endpoints[key]
+            totals['calls'] = totals['calls'] + 1
+            if call['status'] >= 400:
+                totals['errors'] = totals['errors'] + 1
+            totals['latency_sum'] = totals['latency_sum'] + call['latency']
+            for name in ('bytes_sent', 'bytes_received', 'parse_time', 'retries', 'rate_sleep', 'concurrency_sleep'):
+                totals[name] = totals[name] + call[name]
+            # Buckets are stored non-cumulatively, and made cumulative on export
+            for index, bound in enumerate(self.buckets):
+                if call['latency'] <= bound:
+                    totals['buckets'][index] = totals['buckets'][index] + 1
+                    break
+
+        if self.traceHook is not None:
+            # The call has already completed (an update may have been applied), so a failing hook must not change its
+            #   result
+            try:
+                self.traceHook(call)
+            except Exception as e:
+                print('WARNING: QualysMetrics.record: traceHook failed (%s: %s)' % (type(e).__name__, e))
+
+    def to_json(self):
+        with self._lock:
+            ret_val = []
+            for (endpoint, action), totals in sorted(self.endpoints.items(), key=lambda item: str(item[0])):
+                entry = {'endpoint': endpoint, 'action': action}
+                entry.update({name: value for name, value in totals.items() if name != 'buckets'})
+                entry['latency_buckets'] = {str(bound): count for bound, count in zip(self.buckets, totals['buckets'])}
+                entry['latency_buckets']['+Inf'] = totals['calls'] - sum(totals['buckets'])
+                ret_val.append(entry)
+        return json.dumps({'endpoints': ret_val}, indent=2)
+
+    def to_prometheus(self):
+        counters = [('calls', 'qualysapi_calls_total', 'API calls completed'),
+                    ('errors', 'qualysapi_errors_total', 'API calls completed with an HTTP error status'),
+                    ('retries', 'qualysapi_retries_total', 'Retries after rate or concurrency limit rejections'),
+                    ('bytes_sent', 'qualysapi_bytes_sent_total', 'Bytes of URL and body sent'),
+                    ('bytes_received', 'qualysapi_bytes_received_total', 'Bytes of (decompressed) body received'),
+                    ('parse_time', 'qualysapi_parse_seconds_total', 'Seconds spent parsing responses'),
+                    ('rate_sleep', 'qualysapi_rate_limit_sleep_seconds_total', 'Seconds waited for the rate limit'),
+                    ('concurrency_sleep', 'qualysapi_concurrency_limit_sleep_seconds_total',
+                     'Seconds waited for the concurrency limit')]
+        lines = []
+        with self._lock:
+            items = sorted(self.endpoints.items(), key=lambda item: str(item[0]))
+            labels = {key: 'endpoint="%s",action="%s"' % (key[0].replace('"', '\\"'), str(key[1]).replace('"', '\\"'))
+                      for key, totals in items}
+
+            lines.append('# HELP qualysapi_call_duration_seconds API call latency')
+            lines.append('# TYPE qualysapi_call_duration_seconds histogram')
+            for key, totals in items:
+                cumulative = 0
+                for bound, count in zip(self.buckets, totals['buckets']):
+                    cumulative = cumulative + count
+                    lines.append('qualysapi_call_duration_seconds_bucket{%s,le="%s"} %s' %
+                                 (labels[key], bound, cumulative))
+                lines.append('qualysapi_call_duration_seconds_bucket{%s,le="+Inf"} %s' % (labels[key], totals['calls']))
+                lines.append('qualysapi_call_duration_seconds_sum{%s} %s' % (labels[key], totals['latency_sum']))
+                lines.append('qualysapi_call_duration_seconds_count{%s} %s' % (labels[key], totals['calls']))
+
+            for name, metric, help_text in counters:
+                lines.append('# HELP %s %s' % (metric, help_text))
+                lines.append('# TYPE %s counter' % metric)
+                for key, totals in items:
+                    lines.append('%s{%s} %s' % (metric, labels[key], totals[name]))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, file, format='json'):
+        if format == 'prometheus':
+            text = self.to_prometheus()
+        else:
+            text = self.to_json()
+        tmp_file = '%s.%s.tmp' % (file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            f.write(text)
+        os.replace(tmp_file, file)
@@ -0,0 +1,347 @@
+import argparse
+import secrets
+import threading
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from time import monotonic, sleep
+from urllib.parse import urlparse, parse_qs
+from xml.sax.saxutils import escape
+
+
+class QualysMockServer:
+    """Local stand-in for the Qualys appliance API, for benchmarking and testing without a real subscription
+
+    Serves /api/2.0/fo/appliance/ action=list (basic and output_mode=full, with optional ids) and action=update for a
+    generated fleet of appliances, applying updates to its own copy of the configuration.  Optionally enforces a rate
+    limit and a concurrency limit, returning the same headers and 409 responses as the platform, and adds latency to
+    every call.  Calls must carry basic auth or the QualysSession cookie set by /api/2.0/fo/session/ action=login, and
+    responses are gzip compressed when the client accepts it.
+
+    Class Members
+    =============
+
+    appliances          : Integer : The number of appliances in the fleet
+    vlans               : Integer : The number of VLANs (and static routes) each appliance starts with
+    latency             : Float   : Seconds added to every call
+    rateLimit           : Integer : Calls allowed per rate limit window (0 for no limit)
+    rateWindow          : Integer : Length of the rate limit window in seconds
+    concurrencyLimit    : Integer : Calls allowed to run at once (0 for no limit)
+    stats               : Dict    : Counts of 'calls', 'lists', 'updates', 'rate_limited', 'concurrency_limited',
+                                    'logins', 'basic_auth' (calls authenticated with basic auth) and 'connections'
+    server              : ThreadingHTTPServer : The HTTP server, once started
+    url                 : String  : The base URL of the server, once started
+
+    Class Methods
+    =============
+
+    __init__(appliances, vlans, latency, rateLimit, rateWindow, concurrencyLimit)
+
+        Called when an object of type QualysMockServer is created, parameters as the class members above
+
+    start(host, port)
+
+        Start serving in a background thread.  port 0 picks a free port.  Returns the base URL
+
+    stop()
+
+        Stop serving
+
+    appliance_name(index) / appliance_id(index)
+
+        The name and ID of the appliance at index (0 to appliances - 1)
+    """
+
+    appliances: int
+    vlans: int
+    latency: float
+    rateLimit: int
+    rateWindow: int
+    concurrencyLimit: int
+    stats: dict
+    url: str
+
+    def __init__(self, appliances=100, vlans=10, latency=0.0, rateLimit=0, rateWindow=3600, concurrencyLimit=0):
+        self.appliances = appliances
+        self.vlans = vlans
+        self.latency = latency
+        self.rateLimit = rateLimit
+        self.rateWindow = rateWindow
+        self.concurrencyLimit = concurrencyLimit
+        self.stats = {'calls': 0, 'lists': 0, 'updates': 0, 'rate_limited': 0, 'concurrency_limited': 0, 'logins': 0,
+                      'basic_auth': 0, 'connections': 0}
+        self.server = None
+        self.url = None
+        # Appliance ID as key, (set_vlans, set_routes) values as value, for appliances which have been updated
+        self._updated = {}
+        # The QualysSession cookie values of the sessions logged in
+        self._sessions = set()
+        self._running = 0
+        self._windowStart = monotonic()
+        self._windowCalls = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def appliance_name(index):
+        return 'scanner%05d' % index
+
+    @staticmethod
+    def appliance_id(index):
+        return str(100000 + index)
+
+    def _generated(self, index):
+        # The starting configuration of an appliance, in the set_vlans/set_routes formats
+        # VLANs are in 172.16.0.0/12 and routes point at a gateway on the appliance's LAN subnet (10.x.y.0/24)
+        vlans = ['%s|172.%s.%s.1|255.255.255.0|vlan%s' % (v + 1, 16 + (v // 250), v % 250, v + 1)
+                 for v in range(self.vlans)]
+        routes = ['192.%s.%s.0|255.255.255.0|10.%s.%s.254|route%s' % (168 + (r // 250), r % 250, index // 250,
+                                                                       index % 250, r + 1)
+                  for r in range(self.vlans)]
+        return ','.join(vlans), ','.join(routes)
+
+    def _appliance_xml(self, index, full):
+        appliance_id = self.appliance_id(index)
+        xml = '<APPLIANCE><ID>%s</ID><UUID>mock-%s</UUID><NAME>%s</NAME><STATUS>Online</STATUS>' % (
+            appliance_id, appliance_id, self.appliance_name(index))
+        if not full:
+            return xml + '</APPLIANCE>'
+
+        with self._lock:
+            vlans, routes = self._updated.get(appliance_id) or self._generated(index)
+        xml += ('<INTERFACE_SETTINGS><SETTING>Enabled</SETTING><INTERFACE>lan</INTERFACE>'
+                '<IP_ADDRESS>10.%s.%s.10</IP_ADDRESS><NETMASK>255.255.255.0</NETMASK></INTERFACE_SETTINGS>' %
+                (index // 250, index % 250))
+        xml += '<VLANS><SETTING>%s</SETTING>' % ('Enabled' if vlans else 'Disabled')
+        for vlan in filter(None, vlans.split(',')):
+            vlan_id, addr, netmask, name = vlan.split('|', 3)
+            xml += ('<VLAN><ID>%s</ID><NAME>%s</NAME><IP_ADDRESS>%s</IP_ADDRESS><NETMASK>%s</NETMASK></VLAN>' %
+                    (escape(vlan_id), escape(name), escape(addr), escape(netmask)))
+        xml += '</VLANS><STATIC_ROUTES>'
+        for route in filter(None, routes.split(',')):
+            addr, netmask, gateway, name = route.split('|', 3)
+            xml += ('<ROUTE><NAME>%s</NAME><IP_ADDRESS>%s</IP_ADDRESS><NETMASK>%s</NETMASK><GATEWAY>%s</GATEWAY>'
+                    '</ROUTE>' % (escape(name), escape(addr), escape(netmask), escape(gateway)))
+        return xml + '</STATIC_ROUTES></APPLIANCE>'
+
+    def _admit(self):
+        # Returns (headers, rejection) for a new call.  rejection is None if the call may proceed
+        with self._lock:
+            self.stats['calls'] = self.stats['calls'] + 1
+            headers = {}
+            now = monotonic()
+            if self.rateLimit > 0:
+                if now - self._windowStart >= self.rateWindow:
+                    self._windowStart = now
+                    self._windowCalls = 0
+                towait = 0
+                if self._windowCalls >= self.rateLimit:
+                    towait = max(1, int(self._windowStart + self.rateWindow - now + 0.999))
+                else:
+                    self._windowCalls = self._windowCalls + 1
+                headers['X-RateLimit-Limit'] = str(self.rateLimit)
+                headers['X-RateLimit-Window-Sec'] = str(self.rateWindow)
+                headers['X-RateLimit-Remaining'] = str(max(0, self.rateLimit - self._windowCalls))
+                headers['X-RateLimit-ToWait-Sec'] = str(towait)
+                if towait > 0:
+                    self.stats['rate_limited'] = self.stats['rate_limited'] + 1
+                    return headers, ('1965', 'This API cannot be run again for another %s seconds.' % towait)
+
+            self._running = self._running + 1
+            if self.concurrencyLimit > 0:
+                headers['X-Concurrency-Limit-Limit'] = str(self.concurrencyLimit)
+                headers['X-Concurrency-Limit-Running'] = str(self._running)
+                if self._running > self.concurrencyLimit:
+                    self._running = self._running - 1
+                    self.stats['concurrency_limited'] = self.stats['concurrency_limited'] + 1
+                    return headers, ('1960', 'This API cannot be run again until %s currently running instance '
+                                             'has finished.' % self.concurrencyLimit)
+            return headers, None
+
+    def _finish(self):
+        with self._lock:
+            self._running = self._running - 1
+
+    def _make_handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def setup(self):
+                # Called once per connection, so this counts how well clients keep connections alive
+                BaseHTTPRequestHandler.setup(self)
+                with mock._lock:
+                    mock.stats['connections'] = mock.stats['connections'] + 1
+
+            def _send(self, status, headers, body_parts):
+                # Send the body with chunked encoding so large lists are never built in memory
+                self.send_response(status)
+                for header in headers.keys():
+                    self.send_header(header, headers[header])
+                self.send_header('Content-Type', 'text/xml;charset=UTF-8')
+                self.send_header('Transfer-Encoding', 'chunked')
+                compressor = None
+                if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    self.send_header('Content-Encoding', 'gzip')
+                    compressor = zlib.compressobj(wbits=31)
+                self.end_headers()
+                try:
+                    for part in body_parts:
+                        data = part.encode('utf-8')
+                        if compressor is not None:
+                            data = compressor.compress(data)
+                        if len(data) > 0:
+                            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+                    if compressor is not None:
+                        data = compressor.flush()
+                        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+                    self.wfile.write(b'0\r\n\r\n')
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client stopped reading part way through a list, which it may do
+                    self.close_connection = True
+
+            def _simple_return(self, status, headers, text, code=None):
+                body = '<?xml version="1.0" encoding="UTF-8" ?><SIMPLE_RETURN><RESPONSE><DATETIME>now</DATETIME>'
+                if code is not None:
+                    body += '<CODE>%s</CODE>' % code
+                body += '<TEXT>%s</TEXT></RESPONSE></SIMPLE_RETURN>' % escape(text)
+                self._send(status, headers, [body])
+
+            def _params(self):
+                url = urlparse(self.path)
+                params = parse_qs(url.query, keep_blank_values=True)
+                length = int(self.headers.get('Content-Length') or 0)
+                if length > 0:
+                    body = parse_qs(self.rfile.read(length).decode('utf-8'), keep_blank_values=True)
+                    for key in body.keys():
+                        params[key] = body[key]
+                return url.path, {key: value[-1] for key, value in params.items()}
+
+            def _list(self, headers, params):
+                full = params.get('output_mode') == 'full'
+                if params.get('ids'):
+                    wanted = set(params['ids'].split(','))
+                    indexes = [index for index in range(mock.appliances) if mock.appliance_id(index) in wanted]
+                else:
+                    indexes = range(mock.appliances)
+                with mock._lock:
+                    mock.stats['lists'] = mock.stats['lists'] + 1
+
+                def parts():
+                    yield ('<?xml version="1.0" encoding="UTF-8" ?><APPLIANCE_LIST_OUTPUT><RESPONSE>'
+                           '<DATETIME>now</DATETIME><APPLIANCE_LIST>')
+                    for index in indexes:
+                        yield mock._appliance_xml(index, full)
+                    yield '</APPLIANCE_LIST></RESPONSE></APPLIANCE_LIST_OUTPUT>'
+                self._send(200, headers, parts())
+
+            def _update(self, headers, params):
+                appliance_id = params.get('id')
+                index = int(appliance_id) - 100000 if appliance_id and appliance_id.isdigit() else -1
+                if index < 0 or index >= mock.appliances:
+                    self._simple_return(400, headers, 'Scanner Appliance ID %s not found' % appliance_id, '1905')
+                    return
+                with mock._lock:
+                    vlans, routes = mock._updated.get(appliance_id) or mock._generated(index)
+                    mock._updated[appliance_id] = (params.get('set_vlans', vlans), params.get('set_routes', routes))
+                    mock.stats['updates'] = mock.stats['updates'] + 1
+                self._simple_return(200, headers, 'Scanner Appliance updated')
+
+            def _session(self, headers, params):
+                if params.get('action') == 'login':
+                    if not params.get('username') or not params.get('password'):
+                        self._simple_return(401, headers, 'Bad Login/Password', '2001')
+                        return
+                    token = secrets.token_hex(16)
+                    with mock._lock:
+                        mock._sessions.add(token)
+                        mock.stats['logins'] = mock.stats['logins'] + 1
+                    headers['Set-Cookie'] = 'QualysSession=%s; path=/api; HttpOnly' % token
+                    self._simple_return(200, headers, 'Logged in')
+                elif params.get('action') == 'logout':
+                    with mock._lock:
+                        mock._sessions.discard(self._cookie())
+                    self._simple_return(200, headers, 'Logged out')
+                else:
+                    self._simple_return(400, headers, 'Unsupported request', '999')
+
+            def _cookie(self):
+                for cookie in self.headers.get('Cookie', '').split(';'):
+                    name, _, value = cookie.strip().partition('=')
+                    if name == 'QualysSession':
+                        return value
+                return None
+
+            def _authenticated(self):
+                if self.headers.get('Authorization', '').startswith('Basic '):
+                    with mock._lock:
+                        mock.stats['basic_auth'] = mock.stats['basic_auth'] + 1
+                    return True
+                with mock._lock:
+                    return self._cookie() in mock._sessions
+
+            def _handle(self):
+                path, params = self._params()
+                headers, rejection = mock._admit()
+                if rejection is not None:
+                    self._simple_return(409, headers, rejection[1], rejection[0])
+                    return
+                try:
+                    if mock.latency > 0:
+                        sleep(mock.latency)
+                    if path == '/api/2.0/fo/session/':
+                        self._session(headers, params)
+                    elif not self._authenticated():
+                        self._simple_return(401, headers, 'Bad Login/Password', '2001')
+                    elif path == '/api/2.0/fo/appliance/' and params.get('action') == 'list':
+                        self._list(headers, params)
+                    elif path == '/api/2.0/fo/appliance/' and params.get('action') == 'update':
+                        self._update(headers, params)
+                    else:
+                        self._simple_return(400, headers, 'Unsupported request', '999')
+                finally:
+                    mock._finish()
+
+            do_GET = _handle
+            do_POST = _handle
+
+        return Handler
+
+    def start(self, host='127.0.0.1', port=0):
+        self.server = ThreadingHTTPServer((host, port), self._make_handler())
+        self.server.daemon_threads = True
+        self.url = 'http://%s:%s' % (host, self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local mock of the Qualys appliance API')
+    parser.add_argument('-n', '--appliances', help='Number of appliances (default 100)', type=int, default=100)
+    parser.add_argument('-m', '--vlans', help='Number of VLANs and routes per appliance (default 10)', type=int,
+                        default=10)
+    parser.add_argument('-l', '--latency', help='Seconds of latency added to every call (default 0)', type=float,
+                        default=0.0)
+    parser.add_argument('--rate_limit', help='Calls per rate limit window (default 0, no limit)', type=int, default=0)
+    parser.add_argument('--rate_window', help='Rate limit window in seconds (default 3600)', type=int, default=3600)
+    parser.add_argument('--concurrency_limit', help='Concurrent calls allowed (default 0, no limit)', type=int,
+                        default=0)
+    parser.add_argument('--port', help='Port to listen on (default 8443)', type=int, default=8443)
+    args = parser.parse_args()
+
+    mock = QualysMockServer(appliances=args.appliances, vlans=args.vlans, latency=args.latency,
+                            rateLimit=args.rate_limit, rateWindow=args.rate_window,
+                            concurrencyLimit=args.concurrency_limit)
+    print('Serving %s appliances on %s' % (args.appliances, mock.start(port=args.port)))
+    try:
+        while True:
+            sleep(60)
+    except KeyboardInterrupt:
+        mock.stop()
+        print('Stats: %s' % mock.stats)
@@ -0,0 +1,182 @@
+import random
+import threading
+from time import monotonic, sleep
+
+
+class QualysRateLimiter:
+    """Client-side token bucket shared by all callers of a QualysAPI object
+
+    The bucket learns the subscription's budget from the X-RateLimit-Limit and X-RateLimit-Window-Sec response headers
+    and is kept in step with the platform using X-RateLimit-Remaining, so calls are paced before the platform rejects
+    them.  When the platform does ask for a wait with X-RateLimit-ToWait-Sec, every caller waits for exactly that long
+    (plus a little jitter) rather than each caller sleeping for a fixed period.
+
+    Class Members
+    =============
+
+    capacity            : Float   : The number of calls allowed per window (None until learned from the platform)
+    rate                : Float   : The number of calls per second the bucket refills at (None until learned)
+    tokens              : Float   : The number of calls which can be made immediately
+    maxBackoff          : Float   : The longest single wait, in seconds, used for concurrency limit backoff
+    baseBackoff         : Float   : The first wait, in seconds, used for concurrency limit backoff
+    rateWaitTime        : Float   : Total seconds callers have spent waiting for the rate limit
+    concurrencyWaitTime : Float   : Total seconds callers have spent waiting for the concurrency limit
+    blockedWaitTime     : Float   : Wall-clock seconds during which at least one caller was waiting for either limit
+
+    Class Methods
+    =============
+
+    __init__(baseBackoff, maxBackoff)
+
+        Called when an object of type QualysRateLimiter is created
+
+            baseBackoff : Float   : The first wait, in seconds, used for concurrency limit backoff
+                                    Default value = 2
+
+            maxBackoff  : Float   : The longest single wait, in seconds, used for concurrency limit backoff
+                                    Default value = 60
+
+    acquire()
+
+        Block until a call may be made under the learned budget, then take a token for it.  Returns the number of
+        seconds spent waiting
+
+    observe(headers)
+
+        Update the bucket from the response headers of a completed call.  If the platform asked us to wait, all
+        callers are blocked in acquire() for that long (plus up to a second of jitter).  Returns the number of seconds
+        the platform asked us to wait (0 if none)
+
+            headers     : Dict    : The HTTP response headers
+
+    backoff(retryCount)
+
+        Wait for a jittered, exponentially increasing period after a concurrency limit rejection
+
+            retryCount  : Integer : The number of times the call has been attempted
+
+    throttledTime()
+
+        Return the total number of seconds callers have spent waiting for rate and concurrency limits, summed over
+        every caller
+
+    blockedTime()
+
+        Return the wall-clock seconds during which at least one caller was waiting for rate or concurrency limits.
+        Unlike throttledTime(), callers waiting at the same time are only counted once
+    """
+
+    capacity: float
+    rate: float
+    tokens: float
+    maxBackoff: float
+    baseBackoff: float
+    rateWaitTime: float
+    concurrencyWaitTime: float
+    blockedWaitTime: float
+
+    def __init__(self, baseBackoff=2.0, maxBackoff=60.0):
+        self.capacity = None
+        self.rate = None
+        self.tokens = 0.0
+        self.baseBackoff = baseBackoff
+        self.maxBackoff = maxBackoff
+        self.rateWaitTime = 0.0
+        self.concurrencyWaitTime = 0.0
+        self.blockedWaitTime = 0.0
+        self._waiting = 0
+        self._waitStart = 0.0
+        self._blockedUntil = 0.0
+        self._updated = monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        # Must be called with self._lock held
+        if self.rate is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _wait(self, waittime):
+        # Sleep for waittime, counting the wall-clock time during which any caller is waiting
+        with self._lock:
+            if self._waiting == 0:
+                self._waitStart = monotonic()
+            self._waiting = self._waiting + 1
+        try:
+            sleep(waittime)
+        finally:
+            with self._lock:
+                self._waiting = self._waiting - 1
+                if self._waiting == 0:
+                    self.blockedWaitTime = self.blockedWaitTime + monotonic() - self._waitStart
+
+    def acquire(self):
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._refill(now)
+                if now < self._blockedUntil:
+                    # The platform has told us to wait, nobody goes until then.  Each caller adds its own jitter so
+                    # they are spread out over the first second after the block lifts rather than all hitting the
+                    # platform at once
+                    waittime = self._blockedUntil - now + random.uniform(0, 1)
+                elif self.rate is None:
+                    # We have not learned the budget yet, so there is nothing to pace against
+                    return waited
+                elif self.tokens >= 1:
+                    self.tokens = self.tokens - 1
+                    return waited
+                else:
+                    # Wait for just long enough for the next token to arrive
+                    waittime = (1 - self.tokens) / self.rate
+            self._wait(waittime)
+            waited = waited + waittime
+            with self._lock:
+                self.rateWaitTime = self.rateWaitTime + waittime
+
+    def observe(self, headers):
+        towait = 0
+        with self._lock:
+            now = monotonic()
+            self._refill(now)
+            if 'X-RateLimit-Limit' in headers.keys() and 'X-RateLimit-Window-Sec' in headers.keys():
+                limit = float(headers['X-RateLimit-Limit'])
+                window = float(headers['X-RateLimit-Window-Sec'])
+                if limit > 0 and window > 0:
+                    if self.rate is None:
+                        # First time we have seen the budget, start with a full bucket and let Remaining correct it
+                        self.tokens = limit
+                    self.capacity = limit
+                    self.rate = limit / window
+            if 'X-RateLimit-Remaining' in headers.keys() and self.rate is not None:
+                # The platform's count is authoritative, but calls of ours still in flight have not been counted by
+                # it yet, so never raise our own count to meet it
+                self.tokens = min(self.tokens, float(headers['X-RateLimit-Remaining']))
+            if 'X-RateLimit-ToWait-Sec' in headers.keys():
+                towait = int(headers['X-RateLimit-ToWait-Sec'])
+                if towait > 0:
+                    # The jitter is added by each caller in acquire()
+                    self.tokens = 0.0
+                    self._blockedUntil = max(self._blockedUntil, now + towait)
+        return towait
+
+    def backoff(self, retryCount):
+        # Exponential backoff with "equal jitter", capped at maxBackoff
+        delay = min(self.maxBackoff, self.baseBackoff * (2 ** max(0, retryCount - 1)))
+        waittime = random.uniform(delay / 2, delay)
+        self._wait(waittime)
+        with self._lock:
+            self.concurrencyWaitTime = self.concurrencyWaitTime + waittime
+        return waittime
+
+    def throttledTime(self):
+        with self._lock:
+            return self.rateWaitTime + self.concurrencyWaitTime
+
+    def blockedTime(self):
+        with self._lock:
+            if self._waiting > 0:
+                # Include the wait still in progress
+                return self.blockedWaitTime + monotonic() - self._waitStart
+            return self.blockedWaitTime
@@ -1,18 +1,42 @@
-from dataclasses import dataclass, field
+import sys
+from dataclasses import dataclass
+import QualysIPv4
 
 
-@dataclass(eq=True, frozen=False, unsafe_hash=True)
+@dataclass(eq=True, frozen=True, slots=True)
 class QualysRoute:
-    route_name: str = field()
-    ipv4_address: str = field(hash=False)
-    netmask: str = field(hash=False)
-    ipv4_gateway: str = field(hash=None)
+    # Addresses are held packed into integers and names are interned, as a fleet can hold tens of thousands of these.
+    # Objects are immutable values, so a route is changed by replacing it in its appliance's routes dict
+    route_name: str
+    address: int
+    mask: int
+    gateway: int
 
     def __init__(self, route_name, ipv4_address, netmask, ipv4_gateway):
-        self.route_name = route_name
-        self.ipv4_address = ipv4_address
-        self.netmask = netmask
-        self.ipv4_gateway = ipv4_gateway
+        # Stripped as the route name is the key of the appliance's routes dict, matched against the CSV files
+        object.__setattr__(self, 'route_name', sys.intern(route_name.strip()) if route_name is not None else None)
+        object.__setattr__(self, 'address', QualysIPv4.pack(ipv4_address))
+        object.__setattr__(self, 'mask', QualysIPv4.pack(netmask))
+        object.__setattr__(self, 'gateway', QualysIPv4.pack(ipv4_gateway))
+
+    @property
+    def ipv4_address(self):
+        return QualysIPv4.unpack(self.address)
+
+    @property
+    def netmask(self):
+        return QualysIPv4.unpack(self.mask)
+
+    @property
+    def ipv4_gateway(self):
+        return QualysIPv4.unpack(self.gateway)
 
     def create_url(self):
         return "%s|%s|%s|%s" % (self.ipv4_address, self.netmask, self.ipv4_gateway, self.route_name)
+
+    def to_list(self):
+        return [self.route_name, self.address, self.mask, self.gateway]
+
+    @classmethod
+    def from_list(cls, values):
+        return cls(*values)
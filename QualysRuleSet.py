@@ -0,0 +1,199 @@
+import bisect
+import fnmatch
+import json
+import re
+
+
+class QualysRuleSet:
+    """Class to expand a file of targeting rules into VLAN and Static Route rows for every appliance they match
+
+    The rule file is a JSON list of rules.  Each rule selects appliances with exactly one of 'name' (a glob such as
+    "scanner-eu-*"), 'regex' (a regular expression which must match the whole appliance name) or 'ids' (a list of
+    appliance IDs), and holds 'vlans' and/or 'routes' lists and an optional 'action' ('add', the default, or
+    'remove').  Each VLAN is a dict of id, address, netmask and name, and each route a dict of name, address, netmask
+    and gateway.  Values are templates for str.format, given the appliance's name and id and the named groups of the
+    rule's regex, so "10.{site}.0.1" with a regex group named site gives each appliance its own address.
+
+        [{"regex": "scanner-(?P<site>[0-9]+)", "vlans": [{"id": "100", "address": "10.{site}.0.1",
+                                                           "netmask": "255.255.255.0", "name": "site{site}"}]},
+         {"name": "*", "routes": [{"name": "dc", "address": "10.0.0.0", "netmask": "255.0.0.0",
+                                    "gateway": "172.16.0.254"}]}]
+
+    Rules are compiled once when the file is loaded.  Names are matched through an index: an ID list or a glob or regex
+    without wildcards is a dict lookup, and a pattern starting with literal text is only tried against the names with
+    that prefix, found by bisection of the sorted names.  The rows produced are the same as those read from the CSV
+    files, in rule order, and are validated and applied in the same way.
+
+    Class Members
+    =============
+
+    file            : String  : The path of the rule file
+    rules           : List    : The compiled rules, in file order
+    problems        : List    : A description of each problem found in the rule file or while expanding it
+
+    Class Methods
+    =============
+
+    __init__(file)
+
+        Called when an object of type QualysRuleSet is created.  Loads and compiles the rule file, adding any problems
+        to the problems list
+
+            file        : String  : The path of the rule file
+                                    NO DEFAULT VALUE, REQUIRED PARAMETER
+
+    has_vlans() / has_routes()
+
+        Return True if any rule holds VLANs (or routes)
+
+    expand(appliances)
+
+        Return a tuple of (vlan_rows, route_rows) for the appliances matched by the rules, each row being in the same
+        form as a row of the VLAN or route CSV file
+
+            appliances  : Dict    : Appliance name as key, appliance ID as value (as returned by get_appliances)
+    """
+
+    file: str
+    rules: list
+    problems: list
+
+    # The keys of each VLAN and route, in the order of the CSV file columns
+    vlan_keys = ('id', 'address', 'netmask', 'name')
+    route_keys = ('name', 'address', 'netmask', 'gateway')
+
+    def __init__(self, file):
+        self.file = file
+        self.rules = []
+        self.problems = []
+
+        try:
+            with open(file) as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            self.problems.append('%s: %s' % (file, e))
+            return
+        if not isinstance(entries, list):
+            self.problems.append('%s: Must contain a list of rules' % file)
+            return
+
+        for number, entry in enumerate(entries, start=1):
+            rule = self._compile(entry, '%s rule %s' % (file, number))
+            if rule is not None:
+                self.rules.append(rule)
+
+    @staticmethod
+    def _literal_prefix(pattern: str, regex: bool):
+        # The literal text every name matched by the pattern must start with, and whether the pattern is entirely
+        # literal (so can be looked up directly)
+        special = '.^$*+?{}[]()|\\' if regex else '*?[]'
+        if regex and '|' in pattern:
+            # Alternatives may start differently
+            return '', False
+        prefix = ''
+        for char in pattern:
+            if char in special:
+                if regex and char in '?*{' and len(prefix) > 0:
+                    # The last literal character is optional or repeated, so is not part of the prefix
+                    prefix = prefix[:-1]
+                return prefix, False
+            prefix = prefix + char
+        return prefix, True
+
+    def _compile(self, entry, source: str):
+        if not isinstance(entry, dict):
+            self.problems.append('%s: Must be an object' % source)
+            return None
+
+        matchers = [key for key in ('name', 'regex', 'ids') if key in entry.keys()]
+        if len(matchers) != 1:
+            self.problems.append('%s: Must have exactly one of name, regex or ids' % source)
+            return None
+
+        rule = {'source': source, 'action': entry.get('action', 'add'), 'ids': None, 'regex': None, 'glob': None,
+                'prefix': '', 'literal': False, 'vlans': [], 'routes': []}
+        if rule['action'] not in ('add', 'remove'):
+            self.problems.append('%s: Action must be add or remove, found "%s"' % (source, rule['action']))
+
+        if matchers[0] == 'ids':
+            if not isinstance(entry['ids'], list):
+                self.problems.append('%s: ids must be a list' % source)
+                return None
+            rule['ids'] = [str(appliance_id) for appliance_id in entry['ids']]
+        elif matchers[0] == 'regex':
+            pattern = entry['regex']
+            try:
+                rule['regex'] = re.compile(pattern)
+            except re.error as e:
+                self.problems.append('%s: Invalid regex "%s": %s' % (source, pattern, e))
+                return None
+            # fullmatch is used, so anchors at either end change nothing
+            rule['prefix'], rule['literal'] = self._literal_prefix(pattern.lstrip('^').rstrip('$'), regex=True)
+        else:
+            rule['glob'] = entry['name']
+            rule['prefix'], rule['literal'] = self._literal_prefix(entry['name'], regex=False)
+
+        for kind, keys in (('vlans', self.vlan_keys), ('routes', self.route_keys)):
+            items = entry.get(kind, [])
+            if not isinstance(items, list):
+                self.problems.append('%s: %s must be a list' % (source, kind))
+                return None
+            for item in items:
+                if not isinstance(item, dict) or not set(keys).issubset(item.keys()):
+                    self.problems.append('%s: Each of %s must have %s' % (source, kind, ', '.join(keys)))
+                    return None
+                rule[kind].append(tuple(str(item[key]) for key in keys))
+        if len(rule['vlans']) == 0 and len(rule['routes']) == 0:
+            self.problems.append('%s: Must have vlans and/or routes' % source)
+            return None
+        return rule
+
+    def has_vlans(self):
+        return any(len(rule['vlans']) > 0 for rule in self.rules)
+
+    def has_routes(self):
+        return any(len(rule['routes']) > 0 for rule in self.rules)
+
+    @staticmethod
+    def _candidates(rule: dict, names: list, ids: dict):
+        # The names which could match the rule, using the index rather than trying every name
+        if rule['ids'] is not None:
+            return [ids[appliance_id] for appliance_id in rule['ids'] if appliance_id in ids.keys()]
+        if rule['literal']:
+            index = bisect.bisect_left(names, rule['prefix'])
+            if index < len(names) and names[index] == rule['prefix']:
+                return [rule['prefix']]
+            return []
+        if rule['prefix'] == '':
+            return names
+        start = bisect.bisect_left(names, rule['prefix'])
+        # Every name with the prefix sorts before the prefix followed by the highest code point
+        end = bisect.bisect_left(names, rule['prefix'] + '\U0010FFFF', lo=start)
+        return names[start:end]
+
+    def expand(self, appliances: dict):
+        names = sorted(appliances.keys())
+        ids = {appliance_id: name for name, appliance_id in appliances.items()}
+        vlan_rows = []
+        route_rows = []
+        for rule in self.rules:
+            for name in self._candidates(rule, names, ids):
+                fields = {'name': name, 'id': appliances[name]}
+                if rule['regex'] is not None:
+                    match = rule['regex'].fullmatch(name)
+                    if match is None:
+                        continue
+                    fields.update({key: value for key, value in match.groupdict().items() if value is not None})
+                elif rule['glob'] is not None and not fnmatch.fnmatchcase(name, rule['glob']):
+                    continue
+
+                try:
+                    for vlan in rule['vlans']:
+                        vlan_rows.append([name] + [value.format_map(fields) for value in vlan] + [rule['action']])
+                    for route in rule['routes']:
+                        route_rows.append([name] + [value.format_map(fields) for value in route] + [rule['action']])
+                except (KeyError, IndexError, ValueError) as e:
+                    self.problems.append('%s: Appliance %s: Cannot fill in template: %s' % (rule['source'], name,
+                                                                                            e))
+                    break
+        return vlan_rows, route_rows
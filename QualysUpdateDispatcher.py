@@ -0,0 +1,155 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import QualysAPI
+import QualysVirtualScannerAppliance
+import QualysUpdateJournal
+
+
+class QualysUpdateDispatcher:
+    """Class to send appliance update calls to the Qualys platform from a pool of worker threads
+
+    The number of calls allowed in flight at any one time starts at 1 and is raised or lowered after each call
+    according to the X-Concurrency-Limit-Limit and X-Concurrency-Limit-Running headers seen by the QualysAPI object,
+    never exceeding the number of workers.
+
+    Class Members
+    =============
+
+    api             : QualysAPI : The QualysAPI object used to make the update calls
+    workers         : Integer   : The maximum number of update calls in flight at any one time
+    inFlightLimit   : Integer   : The current number of update calls allowed in flight
+    inFlight        : Integer   : The number of update calls currently in flight
+    results         : Dict      : Appliance name as key, (success, message) tuple as value
+    maxRequestSize  : Integer   : The largest update request (URL and body, in bytes) which will be sent
+    journal         : QualysUpdateJournal : If not None, the result of each update is recorded in this journal
+    debug           : Boolean   : If True, will output debug information to the console
+
+    Class Methods
+    =============
+
+    __init__(api, workers, debug, maxRequestSize, journal)
+
+        Called when an object of type QualysUpdateDispatcher is created
+
+            api         : QualysAPI : The QualysAPI object used to make the update calls
+                                      NO DEFAULT VALUE, REQUIRED PARAMETER
+
+            workers     : Integer   : The maximum number of update calls in flight at any one time
+                                      Default value = 1
+
+            debug       : Boolean   : If True, will output debug information to the console
+                                      Default value = False
+
+            maxRequestSize : Integer : The largest update request (URL and body, in bytes) which will be sent.
+                                       Larger requests are reported as failed without being sent
+                                       Default value = 1048576
+
+            journal     : QualysUpdateJournal : If not None, the result of each update is recorded in this journal
+                                                Default value = None
+
+    dispatch(appliances)
+
+        Send the update request of each appliance, returning the results dict
+
+            appliances  : List      : QualysVirtualScannerAppliance objects to be updated, with their update requests
+                                      already built by build_update_request
+    """
+
+    api: QualysAPI.QualysAPI
+    workers: int
+    inFlightLimit: int
+    inFlight: int
+    results: dict
+    maxRequestSize: int
+    journal: QualysUpdateJournal.QualysUpdateJournal
+    debug: bool
+
+    def __init__(self, api: QualysAPI.QualysAPI, workers: int = 1, debug: bool = False,
+                 maxRequestSize: int = 1048576, journal: QualysUpdateJournal.QualysUpdateJournal = None):
+        self.api = api
+        self.journal = journal
+        self.workers = max(1, workers)
+        self.maxRequestSize = maxRequestSize
+        self.inFlightLimit = 1
+        self.inFlight = 0
+        self.results = {}
+        self.debug = debug
+        self._cond = threading.Condition()
+
+    def _acquire(self):
+        # Block until there is room for another call under the current in-flight limit
+        with self._cond:
+            while self.inFlight >= self.inFlightLimit:
+                self._cond.wait()
+            self.inFlight = self.inFlight + 1
+
+    def _release(self):
+        with self._cond:
+            self.inFlight = self.inFlight - 1
+            self._adjust()
+            self._cond.notify_all()
+
+    def _adjust(self):
+        # Must be called with self._cond held
+        climit = self.api.concurrencyLimit
+        crun = self.api.concurrencyRunning
+        if climit is None or crun is None:
+            # The platform has not told us anything about its limits, so open up to the number of workers
+            if self.inFlightLimit < self.workers:
+                self.inFlightLimit = self.inFlightLimit + 1
+            return
+
+        # crun counts every call running on the platform when the response was sent, including the call which has just
+        #   finished and our others in flight, so only what is left once our own calls are taken out belongs to other
+        #   API clients.  Our own calls filling the limit is the point of the pool, not a reason to back off
+        others = max(0, crun - (self.inFlight + 1))
+        room = min(self.workers, max(1, climit - others))
+        if self.inFlightLimit > room:
+            # Other API clients are using part of the subscription's limit, back off by one
+            self.inFlightLimit = self.inFlightLimit - 1
+        elif self.inFlightLimit < room:
+            # There is headroom for at least one more call
+            self.inFlightLimit = self.inFlightLimit + 1
+
+        if self.debug:
+            print('QualysUpdateDispatcher: %s/%s running on platform, in-flight limit now %s' %
+                  (crun, climit, self.inFlightLimit))
+
+    def _update(self, appliance: QualysVirtualScannerAppliance.QualysVirtualScannerAppliance):
+        self._acquire()
+        try:
+            print('Updating Appliance %s' % appliance.name)
+            full_url = self.api.server + appliance.update_url
+            if appliance.request_size() > self.maxRequestSize:
+                # Don't send a request we know will be rejected
+                result = (False, 'Update request is %s bytes, larger than the maximum of %s bytes' %
+                          (appliance.request_size(), self.maxRequestSize))
+            else:
+                # Only the CODE and TEXT of the response are needed, so don't decode or fully parse it
+                resp = self.api.makeCall(url=full_url, payload=appliance.update_payload, method='POST',
+                                         headers={'Content-Type': 'application/x-www-form-urlencoded'},
+                                         returnwith='fields', fields=('RESPONSE/CODE', 'RESPONSE/TEXT'))
+                if resp['RESPONSE/CODE'] is not None:
+                    result = (False, 'CODE=%s : TEXT=%s' % (resp['RESPONSE/CODE'], resp['RESPONSE/TEXT']))
+                else:
+                    result = (True, 'Appliance %s updated' % appliance.name)
+        except Exception as e:
+            # A failure for one appliance (dropped connection, unparseable response) must not stop the others
+            result = (False, '%s: %s' % (type(e).__name__, e))
+        finally:
+            self._release()
+
+        if result[0]:
+            print(result[1])
+        else:
+            print('ERROR: Error updating appliance %s (%s)' % (appliance.name, result[1]))
+        self.results[appliance.name] = result
+        if self.journal is not None:
+            self.journal.result(appliance, result[0], result[1])
+        return result
+
+    def dispatch(self, appliances: list):
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for appliance in appliances:
+                executor.submit(self._update, appliance)
+        return self.results
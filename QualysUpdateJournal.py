@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import threading
+from time import time
+import QualysVirtualScannerAppliance
+
+
+class QualysUpdateJournal:
+    """Class to keep an append-only journal of appliance updates, so an interrupted rollout can be resumed
+
+    The journal is a JSON Lines file.  Each run appends a 'run' record holding a fingerprint of its inputs, a 'plan'
+    record holding the update request of each appliance it is going to update, and a 'result' record for each update
+    as it completes.  Every record is flushed to disk as it is written.  A resumed run takes the plan of the most recent
+    run and sends only the updates without a successful result, without fetching the inventory again.
+
+    Class Members
+    =============
+
+    file            : String  : The path of the journal file
+
+    Class Methods
+    =============
+
+    __init__(file)
+
+        Called when an object of type QualysUpdateJournal is created
+
+            file        : String  : The path of the journal file
+                                    NO DEFAULT VALUE, REQUIRED PARAMETER
+
+    fingerprint(api_url, user, files, routes, vlans)
+
+        Static method returning a digest of the inputs of a run (including the contents of the CSV files)
+
+    start(fingerprint)
+
+        Record the start of a new run
+
+    plan(appliance)
+
+        Record the update request built for an appliance
+
+    result(appliance, success, message)
+
+        Record the result of an appliance update.  Safe to call from several threads
+
+    pending(fingerprint)
+
+        Return a list of QualysVirtualScannerAppliance objects, with update_url and update_payload set, for the updates
+        of the most recent run still to be applied.  Returns None if the journal has no run matching the fingerprint
+
+    close()
+
+        Close the journal file
+    """
+
+    file: str
+
+    def __init__(self, file):
+        self.file = file
+        self._handle = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(api_url, user, files, routes, vlans):
+        digest = hashlib.sha256()
+        digest.update(('%s\0%s\0%s\0%s\0' % (api_url, user, routes, vlans)).encode('utf-8'))
+        for file in files:
+            if file:
+                with open(file, 'rb') as f:
+                    digest.update(hashlib.sha256(f.read()).digest())
+        return digest.hexdigest()
+
+    @staticmethod
+    def _digest(update_url, update_payload):
+        return hashlib.sha256(('%s\n%s' % (update_url, update_payload)).encode('utf-8')).hexdigest()
+
+    def _write(self, record: dict):
+        record['ts'] = time()
+        with self._lock:
+            if self._handle is None:
+                self._handle = open(self.file, 'a', encoding='utf-8')
+            self._handle.write(json.dumps(record, separators=(',', ':')) + '\n')
+            self._handle.flush()
+            os.fsync(self._handle.fileno())
+
+    def start(self, fingerprint):
+        self._write({'type': 'run', 'fingerprint': fingerprint})
+
+    def plan(self, appliance: QualysVirtualScannerAppliance.QualysVirtualScannerAppliance):
+        self._write({'type': 'plan', 'id': appliance.id, 'name': appliance.name, 'url': appliance.update_url,
+                     'payload': appliance.update_payload,
+                     'digest': self._digest(appliance.update_url, appliance.update_payload)})
+
+    def result(self, appliance: QualysVirtualScannerAppliance.QualysVirtualScannerAppliance, success, message):
+        self._write({'type': 'result', 'id': appliance.id, 'name': appliance.name, 'ok': success, 'message': message,
+                     'digest': self._digest(appliance.update_url, appliance.update_payload)})
+
+    def pending(self, fingerprint):
+        if not os.path.exists(self.file):
+            return None
+
+        planned = None
+        applied = set()
+        with open(self.file, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line may be incomplete if the previous run was killed while writing it
+                    continue
+                if record['type'] == 'run':
+                    # A resumed run does not write a run record, so its results count towards the same plan
+                    planned = {} if record['fingerprint'] == fingerprint else None
+                    applied = set()
+                elif planned is not None and record['type'] == 'plan':
+                    planned[record['id']] = record
+                elif planned is not None and record['type'] == 'result' and record['ok']:
+                    applied.add((record['id'], record['digest']))
+
+        if planned is None:
+            return None
+
+        ret_val = []
+        for record in planned.values():
+            if (record['id'], record['digest']) in applied:
+                continue
+            appliance = QualysVirtualScannerAppliance.QualysVirtualScannerAppliance(id=record['id'],
+                                                                                    name=record['name'])
+            appliance.update_url = record['url']
+            appliance.update_payload = record['payload']
+            ret_val.append(appliance)
+        return ret_val
+
+    def close(self):
+        with self._lock:
+            if self._handle is not None:
+                self._handle.close()
+                self._handle = None
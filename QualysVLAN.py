@@ -1,19 +1,37 @@
-from dataclasses import dataclass, field
+import sys
+from dataclasses import dataclass
+import QualysIPv4
 
 
-@dataclass(eq=True, frozen=False, unsafe_hash=True)
+@dataclass(eq=True, frozen=True, slots=True)
 class QualysVLAN:
-    vlan_id: str = field()
-    vlan_name: str = field(hash=False)
-    ipv4_address: str = field(hash=False)
-    netmask: str = field(hash=False)
+    # Addresses are held packed into integers and names are interned, as a fleet can hold tens of thousands of these.
+    # Objects are immutable values, so a VLAN is changed by replacing it in its appliance's vlans dict
+    vlan_id: str
+    address: int
+    mask: int
+    vlan_name: str
 
     def __init__(self, vlan_id, ipv4_address, netmask, vlan_name):
-        self.vlan_id = vlan_id
-        self.vlan_name = vlan_name
-        self.ipv4_address = ipv4_address
-        self.netmask = netmask
+        object.__setattr__(self, 'vlan_id', sys.intern(str(vlan_id).strip()))
+        object.__setattr__(self, 'address', QualysIPv4.pack(ipv4_address))
+        object.__setattr__(self, 'mask', QualysIPv4.pack(netmask))
+        object.__setattr__(self, 'vlan_name', sys.intern(vlan_name) if vlan_name is not None else None)
+
+    @property
+    def ipv4_address(self):
+        return QualysIPv4.unpack(self.address)
+
+    @property
+    def netmask(self):
+        return QualysIPv4.unpack(self.mask)
 
     def create_url(self):
         return "%s|%s|%s|%s" % (self.vlan_id, self.ipv4_address, self.netmask, self.vlan_name)
 
+    def to_list(self):
+        return [self.vlan_id, self.address, self.mask, self.vlan_name]
+
+    @classmethod
+    def from_list(cls, values):
+        return cls(*values)
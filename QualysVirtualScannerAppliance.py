@@ -2,35 +2,54 @@ from dataclasses import dataclass, field
 import QualysRoute
 import QualysVLAN
 from xml.etree import ElementTree as ET
+from urllib.parse import urlencode
 
 
-@dataclass(eq=True, frozen=False, unsafe_hash=True)
+@dataclass(eq=True, frozen=False, unsafe_hash=True, slots=True)
 class QualysVirtualScannerAppliance:
+    # vlans is keyed by VLAN ID and routes by route name, so lookups and replacements are O(1).  The original_* dicts
+    # hold the configuration as loaded from the platform, for diff()
     id: str = field()
     name: str = field(default=None, hash=False)
-    routes: set = field(default_factory=set, hash=False)
-    vlans: set = field(default_factory=set, hash=False)
+    routes: dict = field(default_factory=dict, hash=False)
+    vlans: dict = field(default_factory=dict, hash=False)
+    interfaces: list = field(default_factory=list, hash=False)
     update_url: str = field(default=None, hash=False)
+    update_payload: str = field(default=None, hash=False)
     dirty: bool = field(default=False, hash=False)
+    original_routes: dict = field(default_factory=dict, hash=False)
+    original_vlans: dict = field(default_factory=dict, hash=False)
 
     def add_route(self, route: QualysRoute.QualysRoute):
-        if not self.routes.__contains__(route):
-            self.routes.add(route)
+        # Adds the route, or replaces an existing route of the same name whose values differ
+        if self.routes.get(route.route_name) != route:
+            self.routes[route.route_name] = route
             self.dirty = True
 
     def remove_route(self, route: QualysRoute.QualysRoute):
-        if self.routes.__contains__(route):
-            self.routes.remove(route)
+        self.remove_route_name(route.route_name)
+
+    def remove_route_name(self, route_name: str):
+        # Removes the route by name alone, whatever its other values
+        route_name = route_name.strip()
+        if route_name in self.routes:
+            del self.routes[route_name]
             self.dirty = True
 
     def add_vlan(self, vlan: QualysVLAN.QualysVLAN):
-        if not self.vlans.__contains__(vlan):
-            self.vlans.add(vlan)
+        # Adds the VLAN, or replaces an existing VLAN with the same ID whose values differ
+        if self.vlans.get(vlan.vlan_id) != vlan:
+            self.vlans[vlan.vlan_id] = vlan
             self.dirty = True
 
     def remove_vlan(self, vlan: QualysVLAN.QualysVLAN):
-        if self.vlans.__contains__(vlan):
-            self.vlans.remove(vlan)
+        self.remove_vlan_id(vlan.vlan_id)
+
+    def remove_vlan_id(self, vlan_id: str):
+        # Removes the VLAN by ID alone, whatever its other values
+        vlan_id = str(vlan_id).strip()
+        if vlan_id in self.vlans:
+            del self.vlans[vlan_id]
             self.dirty = True
 
     def get_from_xml(self, appliance_xml: ET.Element):
@@ -46,7 +65,7 @@ class QualysVirtualScannerAppliance:
                 vlan_netmask = xml_vlan.find('NETMASK').text
                 vlan = QualysVLAN.QualysVLAN(vlan_id=vlan_id, vlan_name=vlan_name, ipv4_address=vlan_addr,
                                              netmask=vlan_netmask)
-                self.vlans.add(vlan)
+                self.vlans[vlan.vlan_id] = vlan
 
         if appliance_xml.find('STATIC_ROUTES/ROUTE') is not None:
             # Get static routes
@@ -58,30 +77,97 @@ class QualysVirtualScannerAppliance:
                 route_gateway = xml_route.find('GATEWAY').text
                 route = QualysRoute.QualysRoute(route_name=route_name, ipv4_address=route_addr, netmask=route_netmask,
                                                 ipv4_gateway=route_gateway)
-                self.routes.add(route)
+                self.routes[route.route_name] = route
+
+        # Record the addresses of the appliance's own interfaces (where statically configured) so that route gateways
+        # can be checked against them
+        for xml_interface in appliance_xml.findall('.//INTERFACE_SETTINGS'):
+            if_addr = xml_interface.find('IP_ADDRESS')
+            if_netmask = xml_interface.find('NETMASK')
+            if if_addr is not None and if_netmask is not None and if_addr.text and if_netmask.text:
+                self.interfaces.append([if_addr.text, if_netmask.text])
+
+        self.snapshot()
+
+    def snapshot(self):
+        # Record the current VLANs and routes as the configuration held by the platform, against which diff() compares.
+        # The VLAN and route objects are immutable, so copying the dicts is enough
+        self.original_vlans = dict(self.vlans)
+        self.original_routes = dict(self.routes)
+        self.dirty = False
+
+    def revert(self):
+        # Discard any changes made since the configuration was loaded from the platform (or last snapshot)
+        self.vlans = dict(self.original_vlans)
+        self.routes = dict(self.original_routes)
+        self.dirty = False
+
+    @staticmethod
+    def _diff_dict(original: dict, current: dict):
+        # Returns (added, removed, changed) lists, changed holding (old, new) pairs for keys in both whose values differ
+        added = [current[key] for key in sorted(current.keys() - original.keys())]
+        removed = [original[key] for key in sorted(original.keys() - current.keys())]
+        changed = [(original[key], current[key]) for key in sorted(current.keys() & original.keys())
+                   if original[key] != current[key]]
+        return added, removed, changed
+
+    def diff(self, routes: bool = True, vlans: bool = True):
+        # Returns a dict with 'vlans' and/or 'routes' keys, each holding the (added, removed, changed) tuple from
+        # _diff_dict
+        ret_val = {}
+        if vlans:
+            ret_val['vlans'] = self._diff_dict(self.original_vlans, self.vlans)
+        if routes:
+            ret_val['routes'] = self._diff_dict(self.original_routes, self.routes)
+        return ret_val
+
+    def compare(self, live, routes: bool = True, vlans: bool = True):
+        # Returns the difference between this (planned) configuration and that of live, a copy of the same appliance
+        # read back from the platform, in the same form as diff().  Added items are on the platform but not planned,
+        # removed items are planned but not on the platform
+        ret_val = {}
+        if vlans:
+            ret_val['vlans'] = self._diff_dict(self.vlans, live.vlans)
+        if routes:
+            ret_val['routes'] = self._diff_dict(self.routes, live.routes)
+        return ret_val
+
+    def has_changes(self, routes: bool = True, vlans: bool = True):
+        # True only if the effective configuration differs from the platform's, regardless of the dirty flag
+        if not self.dirty:
+            return False
+        return (vlans and self.vlans != self.original_vlans) or (routes and self.routes != self.original_routes)
 
     def build_update_request(self, routes: bool = True, vlans: bool = True):
-        url = '/api/2.0/fo/appliance/?action=update&id=%s' % self.id
+        # The set_routes/set_vlans values are sent form-encoded in the request body rather than in the URL, which
+        # proxies reject once an appliance has a few hundred VLANs.  Each value is built with a single join
+        self.update_url = '/api/2.0/fo/appliance/?action=update&id=%s' % self.id
+        params = {}
         if routes:
-            url = url + '&set_routes='
-            if len(self.routes) > 0:
-                route: QualysRoute.QualysRoute
-                for index, route in enumerate(self.routes):
-                    if index == 0:
-                        url = url + "%s|%s|%s|%s" % (route.ipv4_address, route.netmask, route.ipv4_gateway,
-                                                     route.route_name)
-                    else:
-                        url = url + ",%s|%s|%s|%s" % (route.ipv4_address, route.netmask, route.ipv4_gateway,
-                                                      route.route_name)
+            params['set_routes'] = ','.join(route.create_url() for route in self.routes.values())
         if vlans:
-            url = url + '&set_vlans='
-            if len(self.vlans) > 0:
-                vlan: QualysVLAN.QualysVLAN
+            params['set_vlans'] = ','.join(vlan.create_url() for vlan in self.vlans.values())
+        self.update_payload = urlencode(params)
+
+    def request_size(self):
+        # The number of bytes of URL and body in the update request built by build_update_request
+        return len(self.update_url.encode('utf-8')) + len(self.update_payload.encode('utf-8'))
 
-                for index, vlan in enumerate(self.vlans):
-                    if index == 0:
-                        url = url + "%s|%s|%s|%s" % (vlan.vlan_id, vlan.ipv4_address, vlan.netmask, vlan.vlan_name)
-                    else:
-                        url = url + ",%s|%s|%s|%s" % (vlan.vlan_id, vlan.ipv4_address, vlan.netmask, vlan.vlan_name)
+    def to_list(self):
+        # Compact representation used for caching: [id, name, [vlan, ...], [route, ...], [interface, ...]]
+        return [self.id, self.name, [vlan.to_list() for vlan in self.vlans.values()],
+                [route.to_list() for route in self.routes.values()], self.interfaces]
 
-        self.update_url = url
+    @classmethod
+    def from_list(cls, values):
+        appliance = cls(id=values[0], name=values[1])
+        for vlan in values[2]:
+            vlan = QualysVLAN.QualysVLAN.from_list(vlan)
+            appliance.vlans[vlan.vlan_id] = vlan
+        for route in values[3]:
+            route = QualysRoute.QualysRoute.from_list(route)
+            appliance.routes[route.route_name] = route
+        if len(values) > 4:
+            appliance.interfaces = values[4]
+        appliance.snapshot()
+        return appliance
@@ -0,0 +1,80 @@
+import QualysMockServer
+
+import argparse
+import csv
+import os
+import re
+import subprocess
+import sys
+import tempfile
+from time import monotonic
+
+
+def write_csv_files(directory, mock: QualysMockServer.QualysMockServer, changes: int):
+    # Write VLAN and route CSV files which add one VLAN and one route to the first 'changes' appliances
+    vlans_file = os.path.join(directory, 'vlans.csv')
+    routes_file = os.path.join(directory, 'routes.csv')
+    with open(vlans_file, 'w', newline='') as vlan_csv, open(routes_file, 'w', newline='') as route_csv:
+        vlan_writer = csv.writer(vlan_csv)
+        route_writer = csv.writer(route_csv)
+        for index in range(changes):
+            name = mock.appliance_name(index)
+            vlan_writer.writerow([name, '4000', '172.31.255.1', '255.255.255.0', 'bench', 'add'])
+            route_writer.writerow([name, 'bench', '198.18.0.0', '255.254.0.0',
+                                   '10.%s.%s.1' % (index // 250, index % 250), 'add'])
+    return vlans_file, routes_file
+
+
+def run_configurator(api_url, vlans_file, routes_file, extra_args):
+    # Run vlan_configurator.py against the mock, returning (wall seconds, peak RSS in MB, return code, output)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vlan_configurator.py')
+    command = [sys.executable, script, '-v', vlans_file, '-r', routes_file] + extra_args + ['bench', 'bench', api_url]
+    start = monotonic()
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = proc.stdout.read().decode('utf-8', 'replace')
+    # wait4 gives us the resource usage of this child alone
+    pid, status, rusage = os.wait4(proc.pid, 0)
+    wall = monotonic() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    divisor = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return wall, rusage.ru_maxrss / divisor, proc.returncode, output
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark vlan_configurator.py against a local mock of the Qualys '
+                                                 'appliance API')
+    parser.add_argument('-s', '--sizes', help='Comma separated fleet sizes (default 100,1000,5000)',
+                        default='100,1000,5000')
+    parser.add_argument('-m', '--vlans', help='VLANs and routes per appliance (default 10)', type=int, default=10)
+    parser.add_argument('-c', '--changes', help='Percentage of appliances changed by the CSV files (default 10)',
+                        type=float, default=10.0)
+    parser.add_argument('-l', '--latency', help='Seconds of latency added to every call (default 0.05)', type=float,
+                        default=0.05)
+    parser.add_argument('--rate_limit', help='Calls per rate limit window (default 0, no limit)', type=int, default=0)
+    parser.add_argument('--rate_window', help='Rate limit window in seconds (default 60)', type=int, default=60)
+    parser.add_argument('--concurrency_limit', help='Concurrent calls allowed (default 0, no limit)', type=int,
+                        default=0)
+    parser.add_argument('-a', '--args', help='Extra arguments for vlan_configurator.py (e.g. "-w 8 -f")',
+                        default='')
+    args = parser.parse_args()
+
+    print('%10s %10s %10s %10s %12s %12s %10s %8s' % ('appliances', 'changed', 'wall (s)', 'calls', 'calls/s',
+                                                      'peak RSS MB', 'throttled', 'status'))
+    for size in [int(size) for size in args.sizes.split(',')]:
+        mock = QualysMockServer.QualysMockServer(appliances=size, vlans=args.vlans, latency=args.latency,
+                                                 rateLimit=args.rate_limit, rateWindow=args.rate_window,
+                                                 concurrencyLimit=args.concurrency_limit)
+        api_url = mock.start()
+        changes = max(1, int(size * args.changes / 100))
+        with tempfile.TemporaryDirectory() as directory:
+            vlans_file, routes_file = write_csv_files(directory, mock, changes)
+            wall, rss, returncode, output = run_configurator(api_url, vlans_file, routes_file, args.args.split())
+        mock.stop()
+
+        throttled = re.search(r'([0-9.]+) seconds spent throttled', output)
+        print('%10s %10s %10.2f %10s %12.1f %12.1f %10s %8s' %
+              (size, changes, wall, mock.stats['calls'], mock.stats['calls'] / wall, rss,
+               throttled.group(1) if throttled else '-', 'ok' if returncode == 0 else 'rc=%s' % returncode))
+        if returncode != 0:
+            print(output)
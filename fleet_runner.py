@@ -0,0 +1,159 @@
+import vlan_configurator
+import QualysAPI
+
+import argparse
+import configparser
+import contextlib
+import io
+import json
+import multiprocessing
+import sys
+from getpass import getpass
+from time import monotonic
+
+
+def read_manifest(file, plan=False):
+    # Build the vlan_configurator arguments of each subscription in the manifest.  Each section of the manifest is a
+    # subscription, holding username, password, pod (or api_url) and any long option of vlan_configurator.py, and the
+    # DEFAULT section holds values shared by every subscription.  Returns a list of (subscription, args) tuples, or
+    # None if the manifest has problems (after printing them)
+    manifest = configparser.ConfigParser()
+    if len(manifest.read(file)) == 0:
+        print('ERROR: Could not read manifest %s' % file)
+        return None
+
+    parser = vlan_configurator.build_parser()
+    # The value of every option when it is not given, from which we know the type each value must be converted to
+    defaults = vars(parser.parse_args(['', '', '']))
+    problems = []
+    ret_val = []
+    for subscription in manifest.sections():
+        section = manifest[subscription]
+        if 'pod' in section.keys():
+            api_url = QualysAPI.QualysAPI.podPicker(section['pod'])
+        else:
+            api_url = section.get('api_url')
+        if not api_url or 'username' not in section.keys() or 'password' not in section.keys():
+            problems.append('Subscription %s: Must have username, password and pod or api_url' % subscription)
+            continue
+        password = section['password']
+        if password == '-':
+            # Prompt now, as the workers cannot
+            password = getpass('Enter password for subscription %s: ' % subscription)
+
+        args = parser.parse_args([section['username'], password, api_url])
+        for key in section.keys():
+            if key in ('pod', 'api_url', 'username', 'password'):
+                continue
+            if key not in defaults.keys():
+                problems.append('Subscription %s: Unknown option %s' % (subscription, key))
+                continue
+            try:
+                if isinstance(defaults[key], bool):
+                    setattr(args, key, section.getboolean(key))
+                elif isinstance(defaults[key], int):
+                    setattr(args, key, section.getint(key))
+                elif isinstance(defaults[key], float):
+                    setattr(args, key, section.getfloat(key))
+                else:
+                    setattr(args, key, section[key])
+            except ValueError as e:
+                problems.append('Subscription %s: Option %s: %s' % (subscription, key, e))
+        if plan:
+            args.plan = True
+        ret_val.append((subscription, args))
+
+    if len(problems) > 0:
+        for problem in problems:
+            print('ERROR: %s' % problem)
+        return None
+    if len(ret_val) == 0:
+        print('ERROR: Manifest %s has no subscriptions' % file)
+        return None
+    return ret_val
+
+
+def run_subscription(job):
+    # Pool worker which runs vlan_configurator for one subscription, capturing its output.  Each worker process has its
+    # own QualysAPI object, and so its own rate limiter, for the subscription it is running
+    subscription, args = job
+    output = io.StringIO()
+    start = monotonic()
+    with contextlib.redirect_stdout(output):
+        try:
+            report = vlan_configurator.main(args)
+        except Exception as e:
+            print('ERROR: %s' % e)
+            report = {'api_url': args.api_url, 'status': -1, 'planned': 0, 'updated': 0, 'failed': {}, 'drift': {},
+                      'calls': 0, 'throttled': 0.0}
+    report['subscription'] = subscription
+    report['seconds'] = monotonic() - start
+    report['output'] = output.getvalue()
+    return report
+
+
+def print_report(reports: list):
+    # Print the output of each subscription followed by a combined summary
+    for report in reports:
+        print('===== Subscription %s (%s) =====' % (report['subscription'], report['api_url']))
+        print(report['output'], end='')
+
+    print()
+    print('%-24s %8s %8s %8s %8s %10s %10s %10s' % ('subscription', 'status', 'planned', 'updated', 'failed',
+                                                    'calls', 'throttled', 'seconds'))
+    for report in reports:
+        print('%-24s %8s %8s %8s %8s %10s %10.1f %10.1f' %
+              (report['subscription'], report['status'], report['planned'], report['updated'],
+               len(report['failed']), report['calls'], report['throttled'], report['seconds']))
+    print('%-24s %8s %8s %8s %8s %10s' % ('total', sum(1 for report in reports if report['status'] != 0),
+                                          sum(report['planned'] for report in reports),
+                                          sum(report['updated'] for report in reports),
+                                          sum(len(report['failed']) for report in reports),
+                                          sum(report['calls'] for report in reports)))
+    for report in reports:
+        for app_name, message in report['failed'].items():
+            print('FAILED: %s : %s : %s' % (report['subscription'], app_name, message))
+        for app_name, drift in report['drift'].items():
+            for description in drift:
+                print('DRIFT: %s : %s : %s' % (report['subscription'], app_name, description))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run vlan_configurator.py for every subscription in a manifest, in '
+                                                 'parallel worker processes')
+    parser.add_argument('manifest', help='INI file with a section for each subscription')
+    parser.add_argument('-P', '--processes', help='Number of subscriptions to run at once (default, all of them)',
+                        type=int, default=0)
+    parser.add_argument('--plan', help='Print the changes which would be made in every subscription without updating '
+                                       'any appliances', action='store_true')
+    parser.add_argument('--report', help='Also write the combined report to this file as JSON')
+    args = parser.parse_args()
+
+    jobs = read_manifest(args.manifest, plan=args.plan)
+    if jobs is None:
+        sys.exit(1)
+
+    processes = args.processes
+    if processes <= 0:
+        processes = len(jobs)
+    print('Running %s subscription(s) in %s process(es)' % (len(jobs), min(processes, len(jobs))))
+
+    # Results come back as each subscription finishes, and are reported in manifest order
+    order = [subscription for subscription, job_args in jobs]
+    reports = []
+    with multiprocessing.Pool(processes=min(processes, len(jobs))) as pool:
+        for report in pool.imap_unordered(run_subscription, jobs):
+            print('Subscription %s finished with status %s in %.1f seconds' % (report['subscription'],
+                                                                               report['status'],
+                                                                               report['seconds']))
+            reports.append(report)
+    reports.sort(key=lambda report: order.index(report['subscription']))
+
+    print_report(reports)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(reports, f, indent=2)
+
+    if any(report['status'] != 0 for report in reports):
+        sys.exit(1)
+    sys.exit(0)
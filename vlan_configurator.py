@@ -8,8 +8,22 @@ import configparser
 import argparse
 from getpass import getpass
 import sys
+import json
+import contextlib
+import os
+import signal
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor, Future
+from time import perf_counter
+from urllib.parse import parse_qs
 
 import QualysVirtualScannerAppliance
+import QualysUpdateDispatcher
+import QualysInventoryCache
+import QualysConfigValidator
+import QualysUpdateJournal
+import QualysRuleSet
 
 
 def response_handler(response: ET.ElementTree):
@@ -34,7 +48,11 @@ def update_appliance(url, appliance_id, api: QualysAPI.QualysAPI, virtual=True,
         api_url = "%s/api/2.0/fo/appliance/physical/?action=update&id=%s&%s" % (api.server, appliance_id, url)
     if debug:
         print("API URL : %s" % api_url)
-    api.makeCall(api_url)
+    resp = api.makeCall(api_url, returnwith='fields', fields=('RESPONSE/CODE', 'RESPONSE/TEXT'))
+    if resp['RESPONSE/CODE'] is not None:
+        print('ERROR: API Call FAILED (CODE=%s : TEXT=%s' % (resp['RESPONSE/CODE'], resp['RESPONSE/TEXT']))
+        return False
+    return True
 
 
 def get_appliances(api: QualysAPI.QualysAPI):
@@ -62,130 +80,864 @@ def get_full_appliances(api: QualysAPI.QualysAPI):
     return resp
 
 
-if __name__ == '__main__':
-    # Script entry point
+def iter_full_appliances(api: QualysAPI.QualysAPI, ids: list = None):
+    # Generator which streams the full appliance list and yields a QualysVirtualScannerAppliance object for each
+    # appliance as soon as it has been read, so the full XML document is never held in memory.  If ids is given, only
+    # those appliances are requested.  Yields None if the API call failed
+    full_url = "%s/api/2.0/fo/appliance/?action=list&output_mode=full" % api.server
+    if ids is not None:
+        full_url = full_url + "&ids=%s" % ','.join(ids)
+
+    for elem in api.makeStreamingCall(full_url, tags=('APPLIANCE', 'RESPONSE')):
+        if elem.tag == 'APPLIANCE':
+            appliance = QualysVirtualScannerAppliance.QualysVirtualScannerAppliance(id=elem.find('ID').text)
+            appliance.get_from_xml(elem)
+            yield appliance
+        elif elem.find('CODE') is not None:
+            # The RESPONSE element of a failed call carries CODE and TEXT
+            print('ERROR: API Call FAILED (CODE=%s : TEXT=%s' % (elem.find('CODE').text, elem.find('TEXT').text))
+            yield None
+            return
+
+
+def iter_inventory_appliances(api: QualysAPI.QualysAPI, cache: QualysInventoryCache.QualysInventoryCache = None):
+    # Generator which yields every appliance in the subscription, from the cache if it holds a fresh copy of all of
+    # them, otherwise from the full appliance list (storing each appliance in the cache as it is read).  Yields None
+    # if the API call failed
+    if cache is not None:
+        names = cache.get_names()
+        if names is not None:
+            cached = [cache.get_appliance(appliance_id) for appliance_id in names.values()]
+            if None not in cached:
+                for appliance in cached:
+                    yield appliance
+                return
+
+    names = {}
+    for appliance in iter_full_appliances(api):
+        if appliance is not None:
+            names[appliance.name] = appliance.id
+            if cache is not None:
+                cache.put_appliance(appliance)
+        yield appliance
+        if appliance is None:
+            return
+    if cache is not None:
+        cache.put_names(names)
+
+
+def iter_targeted_appliances(api: QualysAPI.QualysAPI, names: set, batch_size: int = 100,
+                             cache: QualysInventoryCache.QualysInventoryCache = None, appliance_ids: dict = None):
+    # Generator which fetches the full configuration of only the named appliances.  The names are first resolved to
+    # IDs with the lightweight appliance list, then the full configuration is requested for batch_size IDs at a time.
+    # If a cache is given, fresh cached entries are used in place of both calls, and fetched appliances are stored in
+    # it.  If appliance_ids (appliance name to ID dict) is given, it is used in place of the appliance list.  Yields
+    # None if an API call failed or if a name does not exist in the subscription (after printing the error)
+    if appliance_ids is None and cache is not None:
+        appliance_ids = cache.get_names()
+        if appliance_ids is not None and not names.issubset(appliance_ids.keys()):
+            # An appliance may have been added since the names were cached, so ask the platform again
+            appliance_ids = None
+    if appliance_ids is None:
+        appliance_ids = get_appliances(api)
+        if appliance_ids is None:
+            yield None
+            return
+        if cache is not None:
+            cache.put_names(appliance_ids)
+
+    ids = []
+    for name in sorted(names):
+        if name not in appliance_ids.keys():
+            print("Fatal Error: Appliance %s does not exist in subscription" % name)
+            yield None
+            return
+        appliance = None
+        if cache is not None:
+            appliance = cache.get_appliance(appliance_ids[name])
+        if appliance is not None:
+            yield appliance
+        else:
+            ids.append(appliance_ids[name])
+
+    for index in range(0, len(ids), batch_size):
+        for appliance in iter_full_appliances(api, ids=ids[index:index + batch_size]):
+            if appliance is not None and cache is not None:
+                cache.put_appliance(appliance)
+            yield appliance
+            if appliance is None:
+                return
+
+
+def print_plan(appliances: list, routes: bool = True, vlans: bool = True):
+    # Print the per-appliance difference between the platform's configuration and the planned configuration
+    for appliance in appliances:
+        print('Appliance %s (ID %s)' % (appliance.name, appliance.id))
+        for kind, (added, removed, changed) in appliance.diff(routes=routes, vlans=vlans).items():
+            label = 'VLAN' if kind == 'vlans' else 'Route'
+            for item in added:
+                print('  + %s %s' % (label, item.create_url()))
+            for item in removed:
+                print('  - %s %s' % (label, item.create_url()))
+            for old, new in changed:
+                print('  ~ %s %s -> %s' % (label, old.create_url(), new.create_url()))
+
+
+def verify_appliances(api: QualysAPI.QualysAPI, appliances: list, batch_size: int = 100, routes: bool = True,
+                      vlans: bool = True):
+    # Read back the configuration of only the given (updated) appliances, batch_size IDs per API call, and compare it
+    # with the planned configuration.  Returns a dict with the appliance name as key and a list of drift descriptions
+    # as value, for each appliance which does not match its plan, or None if an API call failed
+    planned = {appliance.id: appliance for appliance in appliances}
+    ids = list(planned.keys())
+    ret_val = {}
+    for index in range(0, len(ids), batch_size):
+        for live in iter_full_appliances(api, ids=ids[index:index + batch_size]):
+            if live is None:
+                return None
+            appliance = planned.pop(live.id, None)
+            if appliance is None:
+                continue
+            drift = []
+            for kind, (added, removed, changed) in appliance.compare(live, routes=routes, vlans=vlans).items():
+                label = 'VLAN' if kind == 'vlans' else 'Route'
+                for item in added:
+                    drift.append('Unexpected %s %s' % (label, item.create_url()))
+                for item in removed:
+                    drift.append('Missing %s %s' % (label, item.create_url()))
+                for item, live_item in changed:
+                    drift.append('Changed %s %s (planned %s)' % (label, live_item.create_url(), item.create_url()))
+            if len(drift) > 0:
+                ret_val[appliance.name] = drift
+
+    # Any appliance the platform did not return at all
+    for appliance in planned.values():
+        ret_val[appliance.name] = ['Not found in subscription']
+    return ret_val
+
+
+def send_updates(api: QualysAPI.QualysAPI, appliances: list, workers: int = 1, max_request_size: int = 1048576,
+                 journal: QualysUpdateJournal.QualysUpdateJournal = None,
+                 cache: QualysInventoryCache.QualysInventoryCache = None, debug: bool = False):
+    # Send the update requests (already built) of the appliances, print a summary of the results and return the
+    # results dict of the dispatcher (appliance name as key, (success, message) as value).  The dispatcher sizes the
+    # number of calls in flight according to the concurrency limit headers returned by the platform
+    dispatcher = QualysUpdateDispatcher.QualysUpdateDispatcher(api=api, workers=workers, debug=debug,
+                                                               maxRequestSize=max_request_size, journal=journal)
+    results = dispatcher.dispatch(appliances)
+
+    failed = [app_name for app_name in results.keys() if not results[app_name][0]]
+
+    if cache is not None:
+        # The cached copy of every appliance we updated is now out of date
+        for appliance in appliances:
+            if results[appliance.name][0]:
+                cache.invalidate(appliance.id)
+        cache.save()
+
+    print('%s appliance(s) updated, %s failed' % (len(results) - len(failed), len(failed)))
+    # Workers wait at the same time, so the wall-clock time is reported alongside the sum of their waits
+    print('%s API call(s) made, %.1f seconds spent throttled by rate/concurrency limits (%.1f seconds summed over '
+          'all workers)' % (api.callCount, api.limiter.blockedTime(), api.limiter.throttledTime()))
+    for app_name in failed:
+        print('FAILED: %s : %s' % (app_name, results[app_name][1]))
+    return results
+
+
+def expand_rules(rules: QualysRuleSet.QualysRuleSet, appliance_ids: dict,
+                 validator: QualysConfigValidator.QualysConfigValidator):
+    # Expand the rules into (vlan_rows, route_rows) for the appliances in appliance_ids (appliance name to ID dict) and
+    # check the rows just as the CSV rows are checked.  Returns None (after printing the problems) if any were found
+    vlan_rows, route_rows = rules.expand(appliance_ids)
+    validator.validate_rows(vlan_rows, 'vlan', '%s (expanded)' % rules.file)
+    validator.validate_rows(route_rows, 'route', '%s (expanded)' % rules.file)
+    problems = rules.problems + validator.problems
+    if len(problems) > 0:
+        for problem in problems:
+            print('ERROR: %s' % problem)
+        print('ERROR: %s problem(s) found in rule file, no appliances have been updated' % len(problems))
+        return None
+    print('Rules in %s matched %s VLAN and %s route row(s)' % (rules.file, len(vlan_rows), len(route_rows)))
+    return vlan_rows, route_rows
+
+
+def export_inventory(api: QualysAPI.QualysAPI, kind: str, output: str = '-',
+                     cache: QualysInventoryCache.QualysInventoryCache = None, stdout=None):
+    # Stream the configuration of every appliance in the subscription to output (a file name, or - for standard
+    # output), one appliance at a time as it is downloaded.  kind is 'vlans' or 'routes' for rows in the format of the
+    # VLAN or route CSV file, or 'jsonl' for one JSON object per appliance with the keys used in rule files.  A file is
+    # only replaced once the export is complete.  stdout is the stream written to for standard output, if sys.stdout
+    # has been pointed elsewhere.  Returns the exit status of the script
+    if output == '-':
+        handle = stdout if stdout is not None else sys.stdout
+    else:
+        tmp_file = '%s.%s.tmp' % (output, os.getpid())
+        handle = open(tmp_file, 'w', newline='', encoding='utf-8')
+    writer = csv.writer(handle)
+
+    appliances = 0
+    items = 0
+    complete = False
+    try:
+        for appliance in iter_inventory_appliances(api, cache=cache):
+            if appliance is None:
+                print('ERROR: Could not get scanner appliances from subscription', file=sys.stderr)
+                return -1
+            appliances = appliances + 1
+            if kind == 'vlans':
+                for vlan in appliance.vlans.values():
+                    writer.writerow([appliance.name, vlan.vlan_id, vlan.ipv4_address, vlan.netmask, vlan.vlan_name,
+                                     'add'])
+                items = items + len(appliance.vlans)
+            elif kind == 'routes':
+                for route in appliance.routes.values():
+                    writer.writerow([appliance.name, route.route_name, route.ipv4_address, route.netmask,
+                                     route.ipv4_gateway, 'add'])
+                items = items + len(appliance.routes)
+            else:
+                record = {'id': appliance.id, 'name': appliance.name,
+                          'vlans': [{'id': vlan.vlan_id, 'address': vlan.ipv4_address, 'netmask': vlan.netmask,
+                                     'name': vlan.vlan_name} for vlan in appliance.vlans.values()],
+                          'routes': [{'name': route.route_name, 'address': route.ipv4_address,
+                                      'netmask': route.netmask, 'gateway': route.ipv4_gateway}
+                                     for route in appliance.routes.values()],
+                          'interfaces': appliance.interfaces}
+                handle.write(json.dumps(record, separators=(',', ':')) + '\n')
+                items = items + len(appliance.vlans) + len(appliance.routes)
+        complete = True
+    except BrokenPipeError:
+        # The reader of standard output (such as head) has stopped reading, so point standard output at devnull to
+        # stop the interpreter failing again when it flushes it on exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), handle.fileno())
+        return 0
+    finally:
+        if output != '-':
+            handle.close()
+            if complete:
+                os.replace(tmp_file, output)
+            else:
+                os.remove(tmp_file)
+    if cache is not None:
+        cache.save()
+
+    # The export itself may be on standard output, so the summary goes to standard error
+    print('Exported %s %s from %s appliance(s)' % (items, 'VLANs and routes' if kind == 'jsonl' else kind, appliances),
+          file=sys.stderr)
+    return 0
+
+
+def stream_csv_rows(file, rows: list):
+    # Generator which yields the rows of a VLAN or Route CSV file as they are read, also appending each to rows
+    with open(file, newline='') as csv_file:
+        for row in csv.reader(csv_file, delimiter=',', quotechar='"'):
+            rows.append(row)
+            yield row
+
+
+def group_rows(vlan_rows: list, route_rows: list, groups: dict = None):
+    # Group VLAN and route rows by appliance name, keeping their order.  Returns a dict with the appliance name as key
+    # and a tuple of (vlan rows, route rows) as value.  If groups is given, the rows are added to it
+    if groups is None:
+        groups = {}
+    for row in vlan_rows:
+        groups.setdefault(row[0], ([], []))[0].append(row)
+    for row in route_rows:
+        groups.setdefault(row[0], ([], []))[1].append(row)
+    return groups
+
+
+def ingest_csv(vlans_file, routes_file):
+    # Read, check and group the rows of the VLAN and route CSV files, checking each row as it is read.  Returns a tuple
+    # of (vlan_rows, route_rows, groups, problems), groups as returned by group_rows.  Rows are only grouped if no
+    # problems were found
+    validator = QualysConfigValidator.QualysConfigValidator()
+    vlan_rows = []
+    route_rows = []
+    if vlans_file:
+        validator.validate_rows(stream_csv_rows(vlans_file, vlan_rows), 'vlan', vlans_file)
+    if routes_file:
+        validator.validate_rows(stream_csv_rows(routes_file, route_rows), 'route', routes_file)
+    groups = {}
+    if len(validator.problems) == 0:
+        groups = group_rows(vlan_rows, route_rows)
+    return vlan_rows, route_rows, groups, validator.problems
+
+
+def join_csv(ingest: Future):
+    # Wait for ingest_csv running in the background and return its result, or None (after printing the problems) if
+    # problems were found or a file could not be read
+    try:
+        vlan_rows, route_rows, groups, problems = ingest.result()
+    except OSError as e:
+        print('ERROR: %s' % e)
+        return None
+    if len(problems) > 0:
+        for problem in problems:
+            print('ERROR: %s' % problem)
+        print('ERROR: %s problem(s) found in CSV files, no appliances have been updated' % len(problems))
+        return None
+    return vlan_rows, route_rows, groups
+
+
+def build_parser():
+    # The command line arguments of the script.  The fleet runner builds the arguments of each subscription from the
+    # defaults of this parser
     parser = argparse.ArgumentParser()
 
     parser.add_argument('username', help='API Username')
     parser.add_argument('password', help='API Password (use - to prompt for password')
-    parser.add_argument('api_url', help='The base URL of the API service (e.g. https://qualysapi.qualys.com')
+    parser.add_argument('api_url', help='The base URL of the API service (e.g. https://qualysapi.qualys.com) or a '
+                                        'Qualys Pod code (e.g. EU02)')
     parser.add_argument('-v', '--vlans', help='CSV File containing VLAN configurations')
     parser.add_argument('-r', '--routes', help='CSV File containing Static Route configurations')
     parser.add_argument('-p', '--enable_proxy', help='Enable HTTPS Proxy (required -u or --proxy_url)')
     parser.add_argument('-u', '--proxy_url', help='URL of HTTPS Proxy')
     parser.add_argument('-d', '--debug', help='Enable debug output', action='store_true')
+    parser.add_argument('-w', '--workers', help='Number of appliance updates to send in parallel (default 1)',
+                        type=int, default=1)
+    parser.add_argument('-b', '--batch_size', help='Number of appliances to fetch full configuration for in each '
+                                                   'API call (default 100)', type=int, default=100)
+    parser.add_argument('-f', '--full_inventory', help='Fetch the full configuration of every appliance in the '
+                                                       'subscription, not only those named in the CSV files',
+                        action='store_true')
+    parser.add_argument('-m', '--max_request_size', help='Largest update request to send, in bytes (default 1048576)',
+                        type=int, default=1048576)
+    parser.add_argument('--timeout', help='Seconds to wait for each response from the API server (default 300)',
+                        type=float, default=300.0)
+    parser.add_argument('--session_login', help='Log in to an API session and authenticate with its cookie rather '
+                                                'than sending the password with every call', action='store_true')
+    parser.add_argument('--metrics_file', help='Write API call metrics to this file when the script exits')
+    parser.add_argument('--metrics_format', help='Format of the metrics file: json (default) or prometheus',
+                        choices=['json', 'prometheus'], default='json')
+    parser.add_argument('-j', '--journal', help='Record the planned and applied updates in this journal file')
+    parser.add_argument('--resume', help='Apply the updates of an interrupted run which are not yet recorded as '
+                                         'applied in the journal (requires -j|--journal and the same CSV files)',
+                        action='store_true')
+    parser.add_argument('--plan', help='Print the changes which would be made to each appliance without updating them',
+                        action='store_true')
+    parser.add_argument('--verify', help='Read back the updated appliances and report any which do not have the '
+                                         'planned configuration', action='store_true')
+    parser.add_argument('-e', '--export', help='Write the VLANs or routes of every appliance in the subscription in '
+                                               'the format of the VLAN or route CSV file, or as JSON Lines, instead '
+                                               'of updating any appliances', choices=['vlans', 'routes', 'jsonl'])
+    parser.add_argument('-o', '--output', help='File to write the export to (default - for standard output)',
+                        default='-')
+    parser.add_argument('--rules', help='JSON file of rules adding or removing VLANs and routes on every appliance '
+                                        'they match')
+    parser.add_argument('--daemon', help='Keep running, applying rows as they are added to the CSV files',
+                        action='store_true')
+    parser.add_argument('--poll_interval', help='Seconds between checks of the CSV files in daemon mode (default 2)',
+                        type=float, default=2.0)
+    parser.add_argument('--refresh_interval', help='Seconds between inventory refreshes in daemon mode (default 300)',
+                        type=float, default=300.0)
+    parser.add_argument('-c', '--cache', help='Cache the appliance inventory on disk between runs',
+                        action='store_true')
+    parser.add_argument('--cache_dir', help='Directory for the inventory cache (default ~/.cache/qvsa_configurator)',
+                        default='~/.cache/qvsa_configurator')
+    parser.add_argument('--cache_ttl', help='Number of seconds a cached appliance remains valid (default 300)',
+                        type=int, default=300)
+    parser.add_argument('--refresh', help='Ignore the cached inventory and fetch it again from the platform',
+                        action='store_true')
+    return parser
+
+
+def configure(args, api: QualysAPI.QualysAPI, report: dict, stdout=None,
+              journal: QualysUpdateJournal.QualysUpdateJournal = None):
+    # Fetch, plan and apply the configuration in the CSV files for one subscription.  The counts of planned, updated
+    # and failed appliances are stored in report.  stdout is passed on to export_inventory, and journal (opened by
+    # main for args.journal, or None) records the planned and applied updates.  Returns the exit status of
+    # the script
+    if args.export:
+        # Nothing is changed, so none of the other inputs are needed
+        cache = None
+        if args.cache:
+            cache = QualysInventoryCache.QualysInventoryCache(api_url=api.server, user=args.username,
+                                                              cache_dir=args.cache_dir, ttl=args.cache_ttl,
+                                                              refresh=args.refresh)
+        return export_inventory(api, args.export, output=args.output, cache=cache, stdout=stdout)
+
+    if (not args.vlans) and (not args.routes) and (not args.rules):
+        print('ERROR: Must specify -v|--vlans, -r|--routes and/or --rules')
+        return -1
+
+    # Read and check the CSV files in the background while the appliances are downloaded.  Every row is still checked
+    # before any update is sent, and a problem stops the download as soon as it has been found
+    executor = ThreadPoolExecutor(max_workers=1)
+    ingest = executor.submit(ingest_csv, args.vlans, args.routes)
+    executor.shutdown(wait=False)
+
+    # Rules are compiled now, but can only be expanded into rows once we know the appliance names
+    rules = None
+    if args.rules:
+        rules = QualysRuleSet.QualysRuleSet(args.rules)
+        if len(rules.problems) > 0:
+            for problem in rules.problems:
+                print('ERROR: %s' % problem)
+            print('ERROR: %s problem(s) found in rule file, no appliances have been updated' % len(rules.problems))
+            return 1
+
+    bRoutes = False
+    if args.routes or (rules is not None and rules.has_routes()):
+        bRoutes = True
+    bVLANs = False
+    if args.vlans or (rules is not None and rules.has_vlans()):
+        bVLANs = True
+
+    cache = None
+    if args.cache:
+        cache = QualysInventoryCache.QualysInventoryCache(api_url=api.server, user=args.username,
+                                                          cache_dir=args.cache_dir, ttl=args.cache_ttl,
+                                                          refresh=args.refresh)
+
+    fingerprint = None
+    if journal is not None:
+        fingerprint = QualysUpdateJournal.QualysUpdateJournal.fingerprint(api.server, args.username,
+                                                                          [args.vlans, args.routes, args.rules],
+                                                                          bRoutes, bVLANs)
+
+    if args.daemon or args.resume:
+        # Neither needs the inventory, so there is nothing to overlap with
+        if join_csv(ingest) is None:
+            return 1
+
+    if args.daemon:
+        if args.resume or args.rules:
+            print('ERROR: --resume and --rules cannot be used with --daemon')
+            return -1
+        return run_daemon(args, api, report, routes=bRoutes, vlans=bVLANs, cache=cache, journal=journal)
+
+    if args.resume:
+        # Carry on from the journaled plan of an interrupted run with the same inputs, without fetching the inventory
+        # or planning again
+        if journal is None:
+            print('ERROR: --resume requires -j|--journal')
+            return -1
+        pending = journal.pending(fingerprint)
+        if pending is None:
+            print('ERROR: Journal %s has no run with the same API URL, user and CSV files to resume' % args.journal)
+            return 1
+        print('Resuming from journal %s : %s appliance update(s) still to apply' % (args.journal, len(pending)))
+        report['planned'] = len(pending)
+        if args.plan:
+            # The journal holds the update requests rather than the planned configurations, so print what each
+            # request would set
+            for appliance in pending:
+                print('Appliance %s (ID %s)' % (appliance.name, appliance.id))
+                for key, values in parse_qs(appliance.update_payload, keep_blank_values=True).items():
+                    print('  %s=%s' % (key, values[0]))
+            print('%s appliance(s) would be updated' % len(pending))
+            return 0
+        if args.verify:
+            # The journal holds the update requests but not the planned configurations to compare against
+            print('WARNING: --verify is not available with --resume, updates will not be verified')
+        results = send_updates(api, pending, workers=args.workers, max_request_size=args.max_request_size,
+                               journal=journal, cache=cache, debug=args.debug)
+        report['failed'] = {app_name: results[app_name][1] for app_name in results.keys() if not results[app_name][0]}
+        report['updated'] = len(results) - len(report['failed'])
+        if len(report['failed']) > 0:
+            return 1
+        return 0
+
+    # Next we need the appliances from the subscription to build our internal picture
+    print("Getting appliances from subscription and building vlan/route tables")
 
-    args = parser.parse_args()
-    print("Starting application configuration")
+    # The qvsas dict will contain the appliances as QualysVirtualScannerAppliance objects as values and the Appliance
+    # Name as its key.  The appliance list is parsed as it is downloaded, one appliance at a time
+    qvsas = {}
 
+    rule_rows = None
+    if args.full_inventory:
+        for appliance in iter_inventory_appliances(api, cache=cache):
+            if appliance is None:
+                # If we cannot get a list of appliances, there is nothing more to do so we quit
+                print('ERROR: Could not get scanner appliances from subscription')
+                return -1
+            qvsas[appliance.name] = appliance
+            if ingest.done() and (ingest.exception() is not None or len(ingest.result()[3]) > 0):
+                # The CSV files must be fixed first, so there is no point downloading the rest
+                break
+        csv_rows = join_csv(ingest)
+        if csv_rows is None:
+            return 1
+    else:
+        # Get the appliance names and IDs while the CSV files are read, then fetch the full configuration of only the
+        # appliances named in the CSV files (or matched by the rules)
+        appliance_ids = None
+        if cache is not None:
+            appliance_ids = cache.get_names()
+        if appliance_ids is None:
+            appliance_ids = get_appliances(api)
+            if appliance_ids is None:
+                print('ERROR: Could not get scanner appliances from subscription')
+                return -1
+            if cache is not None:
+                cache.put_names(appliance_ids)
+        csv_rows = join_csv(ingest)
+        if csv_rows is None:
+            return 1
+
+        if rules is not None:
+            rule_rows = expand_rules(rules, appliance_ids, QualysConfigValidator.QualysConfigValidator())
+            if rule_rows is None:
+                return 1
+
+        names = set(csv_rows[2].keys())
+        if rule_rows is not None:
+            names.update([row[0] for row in rule_rows[0]] + [row[0] for row in rule_rows[1]])
+        if not names.issubset(appliance_ids.keys()):
+            # An appliance may have been added since the names were cached, so let iter_targeted_appliances ask the
+            #   platform again
+            appliance_ids = None
+
+        for appliance in iter_targeted_appliances(api, names, batch_size=args.batch_size, cache=cache,
+                                                  appliance_ids=appliance_ids):
+            if appliance is None:
+                print('ERROR: Could not get scanner appliances from subscription')
+                return -1
+            qvsas[appliance.name] = appliance
+
+    if cache is not None:
+        cache.save()
+
+    groups = csv_rows[2]
+    if rules is not None:
+        if rule_rows is None:
+            rule_rows = expand_rules(rules, {app_name: qvsas[app_name].id for app_name in qvsas.keys()},
+                                     QualysConfigValidator.QualysConfigValidator())
+            if rule_rows is None:
+                return 1
+        # The rows produced by the rules are applied after the CSV rows
+        group_rows(rule_rows[0], rule_rows[1], groups)
+
+    if not apply_rows(qvsas, groups):
+        return 1
+
+    status, results = update_changed(args, api, list(qvsas.values()), report, routes=bRoutes, vlans=bVLANs,
+                                     cache=cache, journal=journal, fingerprint=fingerprint)
+    return status
+
+
+def apply_rows(qvsas: dict, groups: dict):
+    # Apply the add/remove instructions of the VLAN and route rows, grouped by appliance name (see group_rows), to the
+    # appliances in qvsas (appliance name as key), looking each appliance up once.  Returns False (after printing the
+    # error) if a group names an appliance not in qvsas
+    for appliance_name in groups.keys():
+        # Get the QualysVirtualScannerAppliance object for the appliance name from the CSV
+        if appliance_name in qvsas.keys():
+            appliance = qvsas[appliance_name]
+        else:
+            print("Fatal Error: Appliance %s does not exist in subscription" % appliance_name)
+            return False
+        vlan_rows, route_rows = groups[appliance_name]
+
+        # Process the vlan CSV rows to build new QualysVLAN objects
+        for row in vlan_rows:
+            if row[5] == 'add':
+                # Create a QualysVLAN object with the vlan configuration contents from the CSV file
+                appliance.add_vlan(QualysVLAN.QualysVLAN(row[1], row[2], row[3], row[4]))
+            elif row[5] == 'remove':
+                # Only the VLAN ID of a remove row is used, the other columns may be empty
+                appliance.remove_vlan_id(row[1])
+            else:
+                print('ERROR: Row %s does not contain an add/remove instruction' % row)
+                return False
+
+        # Process the routes CSV rows to build new QualysRoute objects
+        for row in route_rows:
+            if row[5] == 'add':
+                # Create a QualysRoute object with the route configuration contents from the CSV file
+                appliance.add_route(QualysRoute.QualysRoute(row[1], row[2], row[3], row[4]))
+            elif row[5] == 'remove':
+                # Only the route name of a remove row is used, the other columns may be empty
+                appliance.remove_route_name(row[1])
+            else:
+                print('ERROR: Row %s does not contain an add/remove instruction' % row)
+                return False
+
+    return True
+
+
+def update_changed(args, api: QualysAPI.QualysAPI, appliances: list, report: dict, routes: bool = True,
+                   vlans: bool = True, cache: QualysInventoryCache.QualysInventoryCache = None,
+                   journal: QualysUpdateJournal.QualysUpdateJournal = None, fingerprint: str = None):
+    # Validate, plan (or print the plan of) and send the updates of those appliances whose configuration has changed,
+    # then verify them if args.verify is set.  The counts of planned, updated and failed appliances and any drift are
+    # added to report.  Returns a tuple of the exit status and the dispatcher results dict (empty if no update was
+    # sent)
+    # Collect the appliances whose effective configuration has changed, the rest are skipped.  An add followed by a
+    # remove of the same item, or a re-add of identical values, leaves the appliance dirty but unchanged
+    dirty_appliances = []
+    for appliance in appliances:
+        if appliance.has_changes(routes=routes, vlans=vlans):
+            dirty_appliances.append(appliance)
+        else:
+            print('Skipping Appliance %s : No updates' % appliance.name)
+    report['planned'] = report['planned'] + len(dirty_appliances)
+
+    # Check the resulting configuration of every appliance before the first update is sent
+    validator = QualysConfigValidator.QualysConfigValidator()
+    for appliance in dirty_appliances:
+        validator.validate_appliance(appliance)
+    if len(validator.problems) > 0:
+        for problem in validator.problems:
+            print('ERROR: %s' % problem)
+        print('ERROR: %s problem(s) found in planned configuration, no appliances have been updated' %
+              len(validator.problems))
+        return 1, {}
+
+    if args.plan:
+        # Show what would be changed and stop before any update is sent
+        print_plan(dirty_appliances, routes=routes, vlans=vlans)
+        print('%s appliance(s) would be updated' % len(dirty_appliances))
+        return 0, {}
+
+    # Build every update request up front so that the plan can be journaled before the first update is sent
+    for appliance in dirty_appliances:
+        appliance.build_update_request(routes=routes, vlans=vlans)
+    if journal is not None:
+        journal.start(fingerprint)
+        for appliance in dirty_appliances:
+            journal.plan(appliance)
+
+    # Send the updates from a pool of workers
+    results = send_updates(api, dirty_appliances, workers=args.workers, max_request_size=args.max_request_size,
+                           journal=journal, cache=cache, debug=args.debug)
+    failed = {app_name: results[app_name][1] for app_name in results.keys() if not results[app_name][0]}
+    report['failed'].update(failed)
+    report['updated'] = report['updated'] + len(results) - len(failed)
+
+    if args.verify:
+        # Check that each appliance we updated now has the planned configuration
+        print('Verifying %s updated appliance(s)' % (len(results) - len(failed)))
+        drift = verify_appliances(api, [appliance for appliance in dirty_appliances if results[appliance.name][0]],
+                                  batch_size=args.batch_size, routes=routes, vlans=vlans)
+        if drift is None:
+            print('ERROR: Could not read back updated appliances from subscription')
+            return 1, results
+        report['drift'].update(drift)
+        for app_name in drift.keys():
+            for description in drift[app_name]:
+                print('DRIFT: %s : %s' % (app_name, description))
+        print('%s appliance(s) verified, %s with drift' % (len(results) - len(failed), len(drift)))
+        if len(drift) > 0:
+            return 1, results
+
+    if len(failed) > 0:
+        return 1, results
+
+    return 0, results
+
+
+def csv_state(files: list):
+    # The modification time and size of each file, from which we can tell that one of them has changed
+    ret_val = []
+    for file in files:
+        if not file:
+            continue
+        try:
+            stat = os.stat(file)
+            ret_val.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            ret_val.append(None)
+    return ret_val
+
+
+def run_daemon(args, api: QualysAPI.QualysAPI, report: dict, routes: bool = True, vlans: bool = True,
+               cache: QualysInventoryCache.QualysInventoryCache = None,
+               journal: QualysUpdateJournal.QualysUpdateJournal = None):
+    # Keep running, holding the appliances in memory, and whenever the CSV files change apply only the rows which have
+    # not yet been applied.  A background thread fetches the held appliances again every args.refresh_interval seconds.
+    # Rows whose appliance could not be updated are retried at the next change or refresh.  Runs until interrupted,
+    # then returns the exit status of the script
+    qvsas = {}
+    lock = threading.Lock()
+    stop = threading.Event()
+    refreshed = threading.Event()
+    # Incremented whenever updates are sent, so a refresh which started before them cannot replace the updated
+    #   appliances with their old configuration
+    generation = [0]
+    # The ('vlan' or 'route', row) tuples of the rows applied so far
+    applied = set()
+
+    def refresh():
+        while not stop.wait(args.refresh_interval):
+            with lock:
+                ids = [appliance.id for appliance in qvsas.values()]
+                started = generation[0]
+            if args.full_inventory:
+                appliance_iters = [iter_full_appliances(api)]
+            else:
+                appliance_iters = [iter_full_appliances(api, ids=ids[index:index + args.batch_size])
+                                   for index in range(0, len(ids), args.batch_size)]
+            fresh = {}
+            for appliance in itertools.chain.from_iterable(appliance_iters):
+                if appliance is None:
+                    fresh = None
+                    break
+                fresh[appliance.name] = appliance
+            if fresh is None:
+                print('WARNING: Could not refresh scanner appliances from subscription, will try again in %s seconds' %
+                      args.refresh_interval)
+                continue
+            with lock:
+                if generation[0] == started and len(fresh) > 0:
+                    if args.full_inventory:
+                        qvsas.clear()
+                    qvsas.update(fresh)
+                    refreshed.set()
+
+    def reconcile():
+        start = perf_counter()
+        try:
+            vlan_rows, route_rows, groups, problems = ingest_csv(args.vlans, args.routes)
+        except OSError as e:
+            print('ERROR: %s' % e)
+            return
+        if len(problems) > 0:
+            for problem in problems:
+                print('ERROR: %s' % problem)
+            print('ERROR: %s problem(s) found in CSV files, waiting for them to change' % len(problems))
+            return
+
+        rows = [('vlan', tuple(row)) for row in vlan_rows] + [('route', tuple(row)) for row in route_rows]
+        # Forget rows which are no longer in the files, so they are applied again if they are put back
+        applied.intersection_update(rows)
+        new_rows = [row for row in rows if row not in applied]
+        if len(new_rows) == 0:
+            return
+        names = set(row[1][0] for row in new_rows)
+
+        with lock:
+            missing = names - qvsas.keys()
+        if len(missing) > 0:
+            fetched = []
+            for appliance in iter_targeted_appliances(api, missing, batch_size=args.batch_size, cache=cache):
+                if appliance is None:
+                    print('ERROR: Could not get scanner appliances from subscription, waiting for the CSV files to '
+                          'change')
+                    return
+                fetched.append(appliance)
+            with lock:
+                for appliance in fetched:
+                    qvsas[appliance.name] = appliance
+
+        with lock:
+            apply_rows(qvsas, group_rows([list(row[1]) for row in new_rows if row[0] == 'vlan'],
+                                         [list(row[1]) for row in new_rows if row[0] == 'route']))
+            touched = [qvsas[name] for name in sorted(names)]
+            changed = set(appliance.name for appliance in touched if appliance.has_changes(routes=routes, vlans=vlans))
+            generation[0] = generation[0] + 1
+
+            fingerprint = None
+            if journal is not None:
+                fingerprint = QualysUpdateJournal.QualysUpdateJournal.fingerprint(api.server, args.username,
+                                                                                  [args.vlans, args.routes], routes,
+                                                                                  vlans)
+            status, results = update_changed(args, api, touched, report, routes=routes, vlans=vlans, cache=cache,
+                                             journal=journal, fingerprint=fingerprint)
+
+            # The appliances now match the platform, unless their update was not sent or failed, in which case their
+            #   rows stay unapplied and are retried
+            done = set()
+            for appliance in touched:
+                if appliance.name not in changed or (appliance.name in results and results[appliance.name][0]):
+                    appliance.snapshot()
+                    done.add(appliance.name)
+                else:
+                    appliance.revert()
+            applied.update(row for row in new_rows if row[1][0] in done)
+        print('Reconciled %s new row(s) for %s appliance(s) in %.3f seconds' % (len(new_rows), len(names),
+                                                                              perf_counter() - start))
+
+    if args.full_inventory:
+        # Hold every appliance from the start, rather than fetching them as they are named in the CSV files
+        for appliance in iter_inventory_appliances(api, cache=cache):
+            if appliance is None:
+                print('ERROR: Could not get scanner appliances from subscription')
+                return -1
+            qvsas[appliance.name] = appliance
+
+    # Stop cleanly when terminated as well as when interrupted
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    refresher = threading.Thread(target=refresh, daemon=True)
+    refresher.start()
+    print('Watching %s every %s seconds, refreshing the inventory every %s seconds' %
+          (' and '.join(file for file in [args.vlans, args.routes] if file), args.poll_interval,
+           args.refresh_interval))
+
+    state = None
+    try:
+        while not stop.is_set():
+            new_state = csv_state([args.vlans, args.routes])
+            if new_state != state or refreshed.is_set():
+                state = new_state
+                refreshed.clear()
+                reconcile()
+            stop.wait(args.poll_interval)
+    except KeyboardInterrupt:
+        pass
+    stop.set()
+    print('Stopped watching')
+    return 0
+
+
+def main(args):
+    # Run the script for the subscription in args (as returned by build_parser().parse_args()).  Returns a report dict
+    # holding the exit status, the number of appliances planned for update, updated and failed (with the failure
+    # messages), the drift found by --verify, the number of API calls made and the seconds spent throttled
     if args.password == '-':
         password = getpass('Enter password: ')
     else:
         password = args.password
 
     api_url: str = args.api_url
+    if api_url.upper() in QualysAPI.QualysAPI.pods.keys():
+        api_url = QualysAPI.QualysAPI.podPicker(api_url)
     api_url = api_url.rstrip('/')
 
-    if (not args.vlans) and (not args.routes):
-        print('ERROR: Must specify -v|--vlans and/or -r|--routes')
-        sys.exit(-1)
-
     if args.proxy_url:
         proxy_url = args.proxy_url
     else:
         proxy_url = ''
 
-    # Create our Qualys API object to handle interactions with the Qualys platform
-    api = QualysAPI.QualysAPI(svr=api_url, usr=args.username, passwd=password, proxy=args.proxy_url,
-                              enableProxy=args.enable_proxy, debug=args.debug)
-
-    # First we need a list of appliances from the subscription to build our internal picture
-    print("Getting appliances from subscription and building vlan/route tables")
-    # appliances = get_appliances(api)
-    full_appliances = get_full_appliances(api)
-
-    # The qvsas dict will contain all of the appliances in the subscription as QualysVirtualScannerAppliance objects
-    # as values and the Appliance Name as its key
-    qvsas = {}
-
-    if full_appliances is None:
-        # If we cannot get a list of appliances, there is nothing more to do so we quit
-        print('ERROR: Could not get list of scanner appliances')
-        sys.exit(-1)
-
-    # For each appliance in the full_appliances XML output, create a QualysVirtualScannerAppliance object and add it
-    # to the qvsas dict
-    for xml_appliance in full_appliances.findall('.//APPLIANCE'):
-        appliance_id = xml_appliance.find('ID').text
-        appliance = QualysVirtualScannerAppliance.QualysVirtualScannerAppliance(id=appliance_id)
-        appliance.get_from_xml(xml_appliance)
-        qvsas[appliance.name] = appliance
-
-    # If we have specified '-v' or '--vlans'
-    if args.vlans:
-        # Process the vlan CSV file to build new QualysVLAN objects
-        with open(args.vlans, newline='') as csv_file:
-            vlan_reader = csv.reader(csv_file, delimiter=',', quotechar='"')
-            for row in vlan_reader:
-                # Get the appliance name from the CSV and with it grab the QualysVirtualScannerAppliance object
-                appliance_name = row[0]
-                if appliance_name in qvsas.keys():
-                    appliance = qvsas[appliance_name]
-                else:
-                    print("Fatal Error: Appliance %s does not exist in subscription" % appliance_name)
-                    sys.exit(1)
+    report = {'api_url': api_url, 'status': 0, 'planned': 0, 'updated': 0, 'failed': {}, 'drift': {}, 'calls': 0,
+              'throttled': 0.0}
 
-                # Create a QualysVLAN object with the vlan configuration contents from the CSV file
-                v = QualysVLAN.QualysVLAN(row[1], row[2], row[3], row[4])
-                if row[5] == 'add':
-                    appliance.add_vlan(v)
-                elif row[5] == 'remove':
-                    appliance.remove_vlan(v)
-                else:
-                    print('ERROR: Row %s does not contain an add/remove instruction' % row)
-                    sys.exit(1)
-
-    if args.routes:
-        # Process the routes CSV file to build the routes dictionary, as described above
-        with open(args.routes, newline='') as csv_file:
-            route_reader = csv.reader(csv_file, delimiter=',', quotechar='"')
-            for row in route_reader:
-                # Get the appliance name from the CSV
-                appliance_name = row[0]
-                if appliance_name in qvsas.keys():
-                    appliance = qvsas[appliance_name]
-                else:
-                    print("Fatal Error: Appliance %s does not exist in subscription" % appliance_name)
-                    sys.exit(1)
-
-                # Create an array with the static contents from the CSV file
-                r = QualysRoute.QualysRoute(row[1], row[2], row[3], row[4])
-                if row[5] == 'add':
-                    appliance.add_route(r)
-                elif row[5] == 'remove':
-                    appliance.remove_route(r)
-                else:
-                    print('ERROR: Row %s does not contain an add/remove instruction' % row)
-                    sys.exit(1)
+    # When the export is written to standard output, everything else printed (API retries, debug output and errors)
+    # goes to standard error, so the export can be piped straight into another program
+    stdout = sys.stdout
+    if args.export and args.output == '-':
+        diagnostics = contextlib.redirect_stdout(sys.stderr)
+    else:
+        diagnostics = contextlib.nullcontext()
+
+    with diagnostics:
+        # Create our Qualys API object to handle interactions with the Qualys platform
+        # One connection is kept alive for each update worker, plus one for the inventory refresh of the daemon
+        api = QualysAPI.QualysAPI(svr=api_url, usr=args.username, passwd=password, proxy=proxy_url,
+                                  enableProxy=args.enable_proxy, debug=args.debug, poolSize=max(1, args.workers) + 1,
+                                  readTimeout=args.timeout, sessionLogin=args.session_login)
+        journal = None
+        if args.journal:
+            journal = QualysUpdateJournal.QualysUpdateJournal(args.journal)
+        try:
+            report['status'] = configure(args, api, report, stdout=stdout, journal=journal)
+        finally:
+            report['calls'] = api.callCount
+            report['throttled'] = api.limiter.blockedTime()
+            api.logout()
+            if journal is not None:
+                # Close the append handle, as main() may be run many times in one process (by fleet_runner.py)
+                journal.close()
+            if args.metrics_file:
+                # Written however the run ends, so a failed run still shows where its time went
+                api.metrics.write(args.metrics_file, args.metrics_format)
+    return report
 
-    bRoutes = False
-    if args.routes:
-        bRoutes = True
-    bVLANs = False
-    if args.vlans:
-        bVLANs = True
-    for app_name in qvsas.keys():
-        if qvsas[app_name].dirty:
-            print('Updating Appliance %s' % app_name)
-            qvsas[app_name].build_update_request(routes=bRoutes, vlans=bVLANs)
-            full_url = api.server + qvsas[app_name].update_url
-            resp = api.makeCall(url=full_url, method='POST')
-            if not response_handler(resp):
-                print('ERROR: Error updating appliance %s' % app_name)
-                sys.exit(1)
-            else:
-                print('Appliance %s updated' % app_name)
-        else:
-            print('Skipping Appliance %s : No updates' % app_name)
 
-    sys.exit(0)
+if __name__ == '__main__':
+    # Script entry point
+    args = build_parser().parse_args()
+    if not (args.export and args.output == '-'):
+        print("Starting application configuration")
+    sys.exit(main(args)['status'])